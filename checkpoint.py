@@ -0,0 +1,107 @@
+import atexit, copy, glob, os, queue, random, threading
+import numpy as np
+import torch
+
+
+def rng_state():
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            'numpy': np.random.get_state(),
+            'random': random.getstate()}
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+
+
+def training_ckpt(tensorf, optimizer, scaler, sampler, ray_filter, loop):
+    # TensorBase.get_ckpt plus the training loop state, ray_filter masks the training rays still used
+    ckpt = tensorf.get_ckpt()
+    ckpt.update({'optimizer': optimizer.state_dict(),
+                 'scaler': scaler.state_dict(),
+                 'sampler': sampler.state_dict(),
+                 'loop': loop,
+                 'rng': rng_state()})
+    if ray_filter is not None:
+        ray_filter = ray_filter.reshape(-1).cpu().numpy()
+        ckpt.update({'ray_filter.length': ray_filter.shape[0], 'ray_filter.mask': np.packbits(ray_filter)})
+    return ckpt
+
+
+def ray_filter(ckpt):
+    if 'ray_filter.mask' not in ckpt:
+        return None
+    return torch.from_numpy(np.unpackbits(ckpt['ray_filter.mask'])[:ckpt['ray_filter.length']].astype(bool))
+
+
+def save_training_ckpt(writer, ckpt, logfolder, iteration):
+    path = f'{logfolder}/ckpts/iter_{iteration:06d}.th'
+    writer.write(ckpt, path, rotate=f'{logfolder}/ckpts/iter_*.th')
+    return path
+
+
+def host_snapshot(obj):
+    # host copy of a checkpoint that training can no longer change
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: host_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(host_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class CheckpointWriter:
+    # writes checkpoints on a background thread via a temp file, a rotate pattern keeps the newest `keep`
+    def __init__(self, keep=3, maxsize=1):
+        self.keep = keep
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, ckpt, path, rotate=None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((host_snapshot(ckpt), path, rotate))
+
+    def flush(self):
+        # blocks until everything written so far is on disk
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                ckpt, path, rotate = item
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                torch.save(ckpt, f'{path}.tmp')
+                os.replace(f'{path}.tmp', path)
+                if rotate is not None and self.keep > 0:
+                    # zero padded names, so the newest sort last
+                    for old in sorted(glob.glob(rotate))[:-self.keep]:
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
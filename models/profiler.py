@@ -0,0 +1,185 @@
+import json, os, time
+from collections import defaultdict
+import torch
+from . import tensorBase
+from .tensorBase import AlphaGridMask
+
+
+class StageProfiler:
+    # timers and sample counters for the stages of TensorBase.forward, attach() wraps them and detach() restores them
+    sample_stages = ['sample_ray', 'sample_ray_ndc', 'sample_ray_occupancy', 'sample_ray_importance', 'sample_ray_packed']
+    feature_stages = ['compute_densityfeature', 'compute_appfeature', 'compute_features']
+    packed_samplers = ['march_ray', 'sample_ray_clipped']
+
+    def __init__(self, sync=True):
+        self.sync = sync and torch.cuda.is_available()
+        self.tensorf = None
+        self._patched_module = {}
+        self._patched_class = {}
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self._stack = []
+        self._logged_times, self._logged_counters = {}, {}
+
+    def _timed(self, name, fn, count=None, method=None):
+        # method is what the stack records, it defaults to the stage name
+        method = method or name
+        def wrapped(*args, **kwargs):
+            caller = self._stack[-1] if self._stack else None
+            if name != 'forward' and caller != 'forward':
+                # only stages called by forward itself are recorded, nested ones count towards their caller
+                out = fn(*args, **kwargs)
+                if count is not None and caller == 'sample_ray_packed':
+                    # the packed sampler drops masked samples, its samples going in are the ones its samplers draw
+                    counter, n = count(args, out)
+                    self.counters[counter] += n
+                return out
+            if self.sync:
+                torch.cuda.synchronize()
+            self._stack.append(method)
+            t0 = time.perf_counter()
+            try:
+                out = fn(*args, **kwargs)
+            finally:
+                if self.sync:
+                    torch.cuda.synchronize()
+                dt = time.perf_counter() - t0
+                self._stack.pop()
+                self.times[name] += dt
+                self.calls[name] += 1
+                # whatever forward spends outside its stages: masking, indexing and the final reductions
+                if name == 'forward':
+                    self.times['forward_other'] += dt
+                elif self._stack == ['forward']:
+                    self.times['forward_other'] -= dt
+            if count is not None:
+                counter, n = count(args, out)
+                self.counters[counter] += n
+            return out
+        return wrapped
+
+    def attach(self, tensorf):
+        self.detach()
+        self.tensorf = tensorf
+
+        tensorf.forward = self._timed('forward', tensorf.forward)
+        for name in self.sample_stages:
+            # padded samplers count their points, the packed one counts through the samplers it calls
+            if name == 'sample_ray_packed':
+                count = None
+            elif name == 'sample_ray_occupancy':
+                count = lambda args, out: ('samples_in', int(out[2].sum()))
+            else:
+                count = lambda args, out: ('samples_in', out[0].shape[:-1].numel())
+            setattr(tensorf, name, self._timed('sample_ray', getattr(tensorf, name), count, method=name))
+        for name in self.packed_samplers:
+            # (ray_idx [N], ...), only called by samplers, so they only count for sample_ray_packed
+            setattr(tensorf, name, self._timed('sample_ray', getattr(tensorf, name),
+                                               lambda args, out: ('samples_in', out[0].shape[0]), method=name))
+        for name in self.feature_stages:
+            # points that reach the density lookup have passed the alpha mask
+            count = (lambda args, out: ('samples_after_mask', args[0].shape[0])) if name != 'compute_appfeature' else None
+            setattr(tensorf, name, self._timed(name, getattr(tensorf, name), count))
+        tensorf.shade = self._timed('renderModule', tensorf.shade,
+                                    lambda args, out: ('samples_after_app_mask', args[0].shape[0]))
+
+        # the alpha mask is rebuilt as a new AlphaGridMask by updateAlphaMask, so it is wrapped on the class
+        self._patched_class['sample_alpha'] = AlphaGridMask.sample_alpha
+        AlphaGridMask.sample_alpha = self._timed('sample_alpha', AlphaGridMask.sample_alpha)
+        for name in ['raw2alpha', 'raw2alpha_packed']:
+            self._patched_module[name] = getattr(tensorBase, name)
+            setattr(tensorBase, name, self._timed('raw2alpha', self._patched_module[name]))
+        return self
+
+    def detach(self):
+        if self.tensorf is None:
+            return
+        for name in ['forward', 'shade'] + self.sample_stages + self.packed_samplers + self.feature_stages:
+            self.tensorf.__dict__.pop(name, None)
+        for name, fn in self._patched_class.items():
+            setattr(AlphaGridMask, name, fn)
+        for name, fn in self._patched_module.items():
+            setattr(tensorBase, name, fn)
+        self._patched_class, self._patched_module = {}, {}
+        self.tensorf = None
+
+    def summary(self):
+        total = self.times.get('forward', 0.0)
+        stages = {name: {'total_ms': 1000 * t, 'calls': self.calls.get(name, 0),
+                         'mean_ms': 1000 * t / max(self.calls.get(name, self.calls.get('forward', 0)), 1),
+                         'share': t / total if total > 0 else 0.0}
+                  for name, t in sorted(self.times.items())}
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+    def write_tensorboard(self, summary_writer, global_step, prefix='profile'):
+        # logs what was spent and counted since the previous call, the totals keep accumulating for summary()
+        for name, t in self.times.items():
+            summary_writer.add_scalar(f'{prefix}/{name}_ms', 1000 * (t - self._logged_times.get(name, 0.0)), global_step=global_step)
+        for name, n in self.counters.items():
+            summary_writer.add_scalar(f'{prefix}/{name}', n - self._logged_counters.get(name, 0), global_step=global_step)
+        self._logged_times, self._logged_counters = dict(self.times), dict(self.counters)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class TraceWindow:
+    # traces iterations i - before to i + after with torch.profiler, writing a chrome trace and op tables
+    def __init__(self, logfolder, iterations, before=2, after=3, row_limit=30):
+        self.path = f'{logfolder}/traces'
+        self.row_limit = row_limit
+        self.windows = []
+        for i in sorted(set(iterations)):
+            start, end = max(i - before, 0), i + after
+            if self.windows and start <= self.windows[-1][1] + 1:
+                self.windows[-1][1] = max(self.windows[-1][1], end)
+            else:
+                self.windows.append([start, end])
+        self.prof = None
+        self.cuda = torch.cuda.is_available()
+        # allocator history snapshots need torch >= 2.1
+        self.snapshot = self.cuda and hasattr(torch.cuda.memory, '_record_memory_history')
+
+    def step(self, iteration):
+        # called at the top of every iteration
+        if self.prof is not None and iteration > self.window[1]:
+            self.stop()
+        if self.prof is None and self.windows and iteration == self.windows[0][0]:
+            self.start()
+
+    def start(self):
+        from torch.profiler import profile, ProfilerActivity
+        self.window = self.windows.pop(0)
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if self.cuda else [])
+        self.prof = profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True)
+        if self.snapshot:
+            torch.cuda.memory._record_memory_history(max_entries=100000)
+        self.prof.start()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        self.prof.stop()
+        os.makedirs(self.path, exist_ok=True)
+        tag = f'{self.path}/iter_{self.window[0]:06d}_{self.window[1]:06d}'
+        self.prof.export_chrome_trace(f'{tag}_trace.json')
+        time_key = 'self_cuda_time_total' if self.cuda else 'self_cpu_time_total'
+        memory_key = 'self_cuda_memory_usage' if self.cuda else 'self_cpu_memory_usage'
+        with open(f'{tag}_ops.txt', 'w') as f:
+            f.write(self.prof.key_averages().table(sort_by=time_key, row_limit=self.row_limit))
+            f.write('\n')
+            f.write(self.prof.key_averages().table(sort_by=memory_key, row_limit=self.row_limit))
+        if self.snapshot:
+            torch.cuda.memory._dump_snapshot(f'{tag}_memory.pickle')
+            torch.cuda.memory._record_memory_history(enabled=None)
+        print(f'trace of iterations {self.window[0]}-{self.window[1]} saved to {tag}_trace.json')
+        self.prof = None
+
+    def close(self):
+        self.stop()
+        self.windows = []
@@ -184,10 +184,11 @@ class TensorVMSplit(TensorBase):
     def vector_comp_diffs(self):
         return self.vectorDiffs(self.density_line) + self.vectorDiffs(self.app_line)
     
-    def density_L1(self):
+    def density_L1(self, reg=None):
+        reg = reg if reg is not None else lambda x: torch.mean(torch.abs(x))
         total = 0
         for idx in range(len(self.density_plane)):
-            total = total + torch.mean(torch.abs(self.density_plane[idx])) + torch.mean(torch.abs(self.density_line[idx]))# + torch.mean(torch.abs(self.app_plane[idx])) + torch.mean(torch.abs(self.density_plane[idx]))
+            total = total + reg(self.density_plane[idx]) + reg(self.density_line[idx])# + torch.mean(torch.abs(self.app_plane[idx])) + torch.mean(torch.abs(self.density_plane[idx]))
         return total
     
     def TV_loss_density(self, reg):
@@ -205,9 +206,9 @@ class TensorVMSplit(TensorBase):
     def compute_densityfeature(self, xyz_sampled):
 
         # plane + line basis
-        coordinate_plane = torch.stack((xyz_sampled[..., self.matMode[0]], xyz_sampled[..., self.matMode[1]], xyz_sampled[..., self.matMode[2]])).detach().view(3, -1, 1, 2)
+        coordinate_plane = torch.stack((xyz_sampled[..., self.matMode[0]], xyz_sampled[..., self.matMode[1]], xyz_sampled[..., self.matMode[2]])).detach().view(3, -1, 1, 2).to(self.feature_dtype)
         coordinate_line = torch.stack((xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
-        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2)
+        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2).to(self.feature_dtype)
 
         sigma_feature = torch.zeros((xyz_sampled.shape[0],), device=xyz_sampled.device)
         for idx_plane in range(len(self.density_plane)):
@@ -220,12 +221,28 @@ class TensorVMSplit(TensorBase):
         return sigma_feature
 
 
+    @torch.no_grad()
+    def density_bound(self, lo, hi):
+        # |plane * line| <= max|plane| * max|line| over the texels around the box
+        bound = 0
+        for idx_plane in range(len(self.density_plane)):
+            mat_id_0, mat_id_1 = self.matMode[idx_plane]
+            vec_id = self.vecMode[idx_plane]
+            plane, line = self.density_plane[idx_plane], self.density_line[idx_plane]
+            u0, u1 = self.texel_range(lo[mat_id_0], hi[mat_id_0], plane.shape[-1])
+            v0, v1 = self.texel_range(lo[mat_id_1], hi[mat_id_1], plane.shape[-2])
+            w0, w1 = self.texel_range(lo[vec_id], hi[vec_id], line.shape[-2])
+            plane_max = plane[0, :, v0:v1, u0:u1].abs().flatten(1).amax(1)
+            line_max = line[0, :, w0:w1, 0].abs().amax(1)
+            bound = bound + torch.sum(plane_max.float() * line_max.float())
+        return bound
+
     def compute_appfeature(self, xyz_sampled):
 
         # plane + line basis
-        coordinate_plane = torch.stack((xyz_sampled[..., self.matMode[0]], xyz_sampled[..., self.matMode[1]], xyz_sampled[..., self.matMode[2]])).detach().view(3, -1, 1, 2)
+        coordinate_plane = torch.stack((xyz_sampled[..., self.matMode[0]], xyz_sampled[..., self.matMode[1]], xyz_sampled[..., self.matMode[2]])).detach().view(3, -1, 1, 2).to(self.feature_dtype)
         coordinate_line = torch.stack((xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
-        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2)
+        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2).to(self.feature_dtype)
 
         plane_coef_point,line_coef_point = [],[]
         for idx_plane in range(len(self.app_plane)):
@@ -233,61 +250,89 @@ class TensorVMSplit(TensorBase):
                                                 align_corners=True).view(-1, *xyz_sampled.shape[:1]))
             line_coef_point.append(F.grid_sample(self.app_line[idx_plane], coordinate_line[[idx_plane]],
                                             align_corners=True).view(-1, *xyz_sampled.shape[:1]))
-        plane_coef_point, line_coef_point = torch.cat(plane_coef_point), torch.cat(line_coef_point)
+        plane_coef_point, line_coef_point = self.amp_features(torch.cat(plane_coef_point), torch.cat(line_coef_point))
 
 
         return self.basis_mat((plane_coef_point * line_coef_point).T)
 
+    def compute_features(self, xyz_sampled):
+
+        # density and appearance components stacked per plane, so both come out of a single grid_sample per axis
+        coordinate_plane = torch.stack((xyz_sampled[..., self.matMode[0]], xyz_sampled[..., self.matMode[1]], xyz_sampled[..., self.matMode[2]])).detach().view(3, -1, 1, 2).to(self.feature_dtype)
+        coordinate_line = torch.stack((xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
+        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2).to(self.feature_dtype)
+
+        sigma_feature = torch.zeros((xyz_sampled.shape[0],), device=xyz_sampled.device)
+        plane_coef_point,line_coef_point = [],[]
+        for idx_plane in range(len(self.density_plane)):
+            n_density = self.density_plane[idx_plane].shape[1]
+            plane_feats = F.grid_sample(self.concat_grids(f'plane{idx_plane}', self.density_plane[idx_plane], self.app_plane[idx_plane]),
+                                        coordinate_plane[[idx_plane]], align_corners=True).view(-1, *xyz_sampled.shape[:1])
+            line_feats = F.grid_sample(self.concat_grids(f'line{idx_plane}', self.density_line[idx_plane], self.app_line[idx_plane]),
+                                       coordinate_line[[idx_plane]], align_corners=True).view(-1, *xyz_sampled.shape[:1])
+            sigma_feature = sigma_feature + torch.sum(plane_feats[:n_density] * line_feats[:n_density], dim=0)
+            plane_coef_point.append(plane_feats[n_density:])
+            line_coef_point.append(line_feats[n_density:])
+        plane_coef_point, line_coef_point = self.amp_features(torch.cat(plane_coef_point), torch.cat(line_coef_point))
+
+        return sigma_feature, self.basis_mat((plane_coef_point * line_coef_point).T)
+
 
 
     @torch.no_grad()
-    def up_sampling_VM(self, plane_coef, line_coef, res_target):
+    def up_sampling_VM(self, plane_coef, line_coef, res_target, optimizer=None):
 
         for i in range(len(self.vecMode)):
             vec_id = self.vecMode[i]
             mat_id_0, mat_id_1 = self.matMode[i]
-            plane_coef[i] = torch.nn.Parameter(
-                F.interpolate(plane_coef[i].data, size=(res_target[mat_id_1], res_target[mat_id_0]), mode='bilinear',
-                              align_corners=True))
-            line_coef[i] = torch.nn.Parameter(
-                F.interpolate(line_coef[i].data, size=(res_target[vec_id], 1), mode='bilinear', align_corners=True))
+            # the optimizer moments are resampled like the values, bilinear weights keep exp_avg_sq non negative
+            plane_resample = lambda t: F.interpolate(t, size=(res_target[mat_id_1], res_target[mat_id_0]), mode='bilinear',
+                                                     align_corners=True)
+            line_resample = lambda t: F.interpolate(t, size=(res_target[vec_id], 1), mode='bilinear', align_corners=True)
+            plane_coef[i] = self.swap_param(optimizer, plane_coef[i],
+                                            torch.nn.Parameter(plane_resample(plane_coef[i].data)), plane_resample)
+            line_coef[i] = self.swap_param(optimizer, line_coef[i],
+                                           torch.nn.Parameter(line_resample(line_coef[i].data)), line_resample)
 
 
         return plane_coef, line_coef
 
     @torch.no_grad()
-    def upsample_volume_grid(self, res_target):
-        self.app_plane, self.app_line = self.up_sampling_VM(self.app_plane, self.app_line, res_target)
-        self.density_plane, self.density_line = self.up_sampling_VM(self.density_plane, self.density_line, res_target)
+    def upsample_volume_grid(self, res_target, optimizer=None):
+        self.app_plane, self.app_line = self.up_sampling_VM(self.app_plane, self.app_line, res_target, optimizer)
+        self.density_plane, self.density_line = self.up_sampling_VM(self.density_plane, self.density_line, res_target, optimizer)
 
         self.update_stepSize(res_target)
         print(f'upsamping to {res_target}')
 
     @torch.no_grad()
-    def shrink(self, new_aabb):
+    def shrink(self, new_aabb, optimizer=None):
         print("====> shrinking ...")
         xyz_min, xyz_max = new_aabb
         t_l, b_r = (xyz_min - self.aabb[0]) / self.units, (xyz_max - self.aabb[0]) / self.units
         # print(new_aabb, self.aabb)
-        # print(t_l, b_r,self.alphaMask.alpha_volume.shape)
+        # print(t_l, b_r,self.alphaMask.shape)
         t_l, b_r = torch.round(torch.round(t_l)).long(), torch.round(b_r).long() + 1
         b_r = torch.stack([b_r, self.gridSize]).amin(0)
 
         for i in range(len(self.vecMode)):
             mode0 = self.vecMode[i]
-            self.density_line[i] = torch.nn.Parameter(
+            # the optimizer state is cropped with the values (clone, so the old full size tensors are freed)
+            line_crop = lambda t: t[...,t_l[mode0]:b_r[mode0],:].clone()
+            self.density_line[i] = self.swap_param(optimizer, self.density_line[i], torch.nn.Parameter(
                 self.density_line[i].data[...,t_l[mode0]:b_r[mode0],:]
-            )
-            self.app_line[i] = torch.nn.Parameter(
+            ), line_crop)
+            self.app_line[i] = self.swap_param(optimizer, self.app_line[i], torch.nn.Parameter(
                 self.app_line[i].data[...,t_l[mode0]:b_r[mode0],:]
-            )
+            ), line_crop)
             mode0, mode1 = self.matMode[i]
-            self.density_plane[i] = torch.nn.Parameter(
+            plane_crop = lambda t: t[...,t_l[mode1]:b_r[mode1],t_l[mode0]:b_r[mode0]].clone()
+            self.density_plane[i] = self.swap_param(optimizer, self.density_plane[i], torch.nn.Parameter(
                 self.density_plane[i].data[...,t_l[mode1]:b_r[mode1],t_l[mode0]:b_r[mode0]]
-            )
-            self.app_plane[i] = torch.nn.Parameter(
+            ), plane_crop)
+            self.app_plane[i] = self.swap_param(optimizer, self.app_plane[i], torch.nn.Parameter(
                 self.app_plane[i].data[...,t_l[mode1]:b_r[mode1],t_l[mode0]:b_r[mode0]]
-            )
+            ), plane_crop)
 
 
         if not torch.all(self.alphaMask.gridSize == self.gridSize):
@@ -331,10 +376,20 @@ class TensorCP(TensorBase):
             grad_vars += [{'params':self.renderModule.parameters(), 'lr':lr_init_network}]
         return grad_vars
 
+    @torch.no_grad()
+    def density_bound(self, lo, hi):
+        # |l0 * l1 * l2| <= max|l0| * max|l1| * max|l2| over the texels around the box, for every component
+        bound = 1
+        for idx in range(len(self.density_line)):
+            vec_id = self.vecMode[idx]
+            w0, w1 = self.texel_range(lo[vec_id], hi[vec_id], self.density_line[idx].shape[-2])
+            bound = bound * self.density_line[idx][0, :, w0:w1, 0].abs().amax(1).float()
+        return torch.sum(bound)
+
     def compute_densityfeature(self, xyz_sampled):
 
         coordinate_line = torch.stack((xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
-        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2)
+        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2).to(self.feature_dtype)
 
 
         line_coef_point = F.grid_sample(self.density_line[0], coordinate_line[[0]],
@@ -352,7 +407,7 @@ class TensorCP(TensorBase):
 
         coordinate_line = torch.stack(
             (xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
-        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2)
+        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2).to(self.feature_dtype)
 
 
         line_coef_point = F.grid_sample(self.app_line[0], coordinate_line[[0]],
@@ -363,29 +418,48 @@ class TensorCP(TensorBase):
                                                           align_corners=True).view(-1, *xyz_sampled.shape[:1])
 
         return self.basis_mat(line_coef_point.T)
+
+    def compute_features(self, xyz_sampled):
+
+        # density and appearance lines stacked per axis, one grid_sample per axis for both
+        coordinate_line = torch.stack(
+            (xyz_sampled[..., self.vecMode[0]], xyz_sampled[..., self.vecMode[1]], xyz_sampled[..., self.vecMode[2]]))
+        coordinate_line = torch.stack((torch.zeros_like(coordinate_line), coordinate_line), dim=-1).detach().view(3, -1, 1, 2).to(self.feature_dtype)
+
+        n_density = self.density_line[0].shape[1]
+        line_coef_point = F.grid_sample(self.concat_grids('line0', self.density_line[0], self.app_line[0]), coordinate_line[[0]],
+                                        align_corners=True).view(-1, *xyz_sampled.shape[:1])
+        line_coef_point = line_coef_point * F.grid_sample(self.concat_grids('line1', self.density_line[1], self.app_line[1]), coordinate_line[[1]],
+                                                          align_corners=True).view(-1, *xyz_sampled.shape[:1])
+        line_coef_point = line_coef_point * F.grid_sample(self.concat_grids('line2', self.density_line[2], self.app_line[2]), coordinate_line[[2]],
+                                                          align_corners=True).view(-1, *xyz_sampled.shape[:1])
+        sigma_feature = torch.sum(line_coef_point[:n_density], dim=0)
+
+        return sigma_feature, self.basis_mat(line_coef_point[n_density:].T)
     
 
     @torch.no_grad()
-    def up_sampling_Vector(self, density_line_coef, app_line_coef, res_target):
+    def up_sampling_Vector(self, density_line_coef, app_line_coef, res_target, optimizer=None):
 
         for i in range(len(self.vecMode)):
             vec_id = self.vecMode[i]
-            density_line_coef[i] = torch.nn.Parameter(
-                F.interpolate(density_line_coef[i].data, size=(res_target[vec_id], 1), mode='bilinear', align_corners=True))
-            app_line_coef[i] = torch.nn.Parameter(
-                F.interpolate(app_line_coef[i].data, size=(res_target[vec_id], 1), mode='bilinear', align_corners=True))
+            line_resample = lambda t: F.interpolate(t, size=(res_target[vec_id], 1), mode='bilinear', align_corners=True)
+            density_line_coef[i] = self.swap_param(optimizer, density_line_coef[i],
+                                                   torch.nn.Parameter(line_resample(density_line_coef[i].data)), line_resample)
+            app_line_coef[i] = self.swap_param(optimizer, app_line_coef[i],
+                                               torch.nn.Parameter(line_resample(app_line_coef[i].data)), line_resample)
 
         return density_line_coef, app_line_coef
 
     @torch.no_grad()
-    def upsample_volume_grid(self, res_target):
-        self.density_line, self.app_line = self.up_sampling_Vector(self.density_line, self.app_line, res_target)
+    def upsample_volume_grid(self, res_target, optimizer=None):
+        self.density_line, self.app_line = self.up_sampling_Vector(self.density_line, self.app_line, res_target, optimizer)
 
         self.update_stepSize(res_target)
         print(f'upsamping to {res_target}')
 
     @torch.no_grad()
-    def shrink(self, new_aabb):
+    def shrink(self, new_aabb, optimizer=None):
         print("====> shrinking ...")
         xyz_min, xyz_max = new_aabb
         t_l, b_r = (xyz_min - self.aabb[0]) / self.units, (xyz_max - self.aabb[0]) / self.units
@@ -396,12 +470,13 @@ class TensorCP(TensorBase):
 
         for i in range(len(self.vecMode)):
             mode0 = self.vecMode[i]
-            self.density_line[i] = torch.nn.Parameter(
+            line_crop = lambda t: t[...,t_l[mode0]:b_r[mode0],:].clone()
+            self.density_line[i] = self.swap_param(optimizer, self.density_line[i], torch.nn.Parameter(
                 self.density_line[i].data[...,t_l[mode0]:b_r[mode0],:]
-            )
-            self.app_line[i] = torch.nn.Parameter(
+            ), line_crop)
+            self.app_line[i] = self.swap_param(optimizer, self.app_line[i], torch.nn.Parameter(
                 self.app_line[i].data[...,t_l[mode0]:b_r[mode0],:]
-            )
+            ), line_crop)
 
         if not torch.all(self.alphaMask.gridSize == self.gridSize):
             t_l_r, b_r_r = t_l / (self.gridSize-1), (b_r-1) / (self.gridSize-1)
@@ -415,10 +490,11 @@ class TensorCP(TensorBase):
         self.aabb = new_aabb
         self.update_stepSize((newSize[0], newSize[1], newSize[2]))
 
-    def density_L1(self):
+    def density_L1(self, reg=None):
+        reg = reg if reg is not None else lambda x: torch.mean(torch.abs(x))
         total = 0
         for idx in range(len(self.density_line)):
-            total = total + torch.mean(torch.abs(self.density_line[idx]))
+            total = total + reg(self.density_line[idx])
         return total
 
     def TV_loss_density(self, reg):
@@ -431,4 +507,117 @@ class TensorCP(TensorBase):
         total = 0
         for idx in range(len(self.app_line)):
             total = total + reg(self.app_line[idx]) * 1e-3
-        return total
\ No newline at end of file
+        return total
+
+class TensorBaked(TensorBase):
+    # inference only: density features and basis_mat outputs baked into bricks over the alpha mask
+    def __init__(self, aabb, gridSize, device, brick_size=8, **kargs):
+        self.brick_size = brick_size
+        super(TensorBaked, self).__init__(aabb, gridSize, device, **kargs)
+
+
+    def init_svd_volume(self, res, device):
+        B = self.brick_size
+        n_bricks = torch.div(self.gridSize - 2, B, rounding_mode='floor') + 1
+        self.register_buffer('brick_index', torch.full(n_bricks.tolist(), -1, dtype=torch.int32, device=device))
+        self.register_buffer('brick_pool', torch.zeros((0, (B+1)**3, 1 + self.app_dim), device=device))
+
+    def get_kwargs(self):
+        kwargs = super(TensorBaked, self).get_kwargs()
+        kwargs.update({'brick_size': self.brick_size})
+        return kwargs
+
+    def load(self, ckpt):
+        self.brick_pool = self.brick_pool.new_zeros(ckpt['state_dict']['brick_pool'].shape)
+        super(TensorBaked, self).load(ckpt)
+
+    @classmethod
+    @torch.no_grad()
+    def from_model(cls, tensorf, brick_size=8, chunk=64):
+        kwargs = tensorf.get_kwargs()
+        kwargs.update({'device': tensorf.device, 'brick_size': brick_size})
+        baked = cls(**kwargs)
+        baked.alphaMask = tensorf.alphaMask
+        if isinstance(tensorf.renderModule, torch.nn.Module):
+            baked.renderModule.load_state_dict(tensorf.renderModule.state_dict())
+        baked.bake(tensorf, chunk)
+        return baked
+
+    @torch.no_grad()
+    def bake(self, tensorf, chunk=64):
+        print("====> baking ...")
+        B = self.brick_size
+        cells = self.gridSize - 1
+        n_bricks = torch.tensor(self.brick_index.shape, device=self.device)
+
+        if tensorf.alphaMask is not None:
+            # every brick overlapping an occupied mask cell, the bounds are taken in baked lattice units
+            mask = tensorf.alphaMask
+            occ = mask.cell_occupancy().nonzero().flip(-1)
+            cell_min = mask.aabb[0] + occ * mask.units
+            lo = torch.floor((cell_min - self.aabb[0]) / self.units).long()
+            hi = torch.floor((cell_min + mask.units - self.aabb[0]) / self.units).long()
+            lo = torch.div(torch.minimum(lo.clamp(min=0), cells - 1), B, rounding_mode='floor')
+            hi = torch.div(torch.minimum(hi.clamp(min=0), cells - 1), B, rounding_mode='floor')
+            occupied = torch.zeros(n_bricks.tolist(), dtype=torch.bool, device=self.device)
+            span = int((hi - lo).max().item()) + 1 if occ.shape[0] > 0 else 0
+            for dx in range(span):
+                for dy in range(span):
+                    for dz in range(span):
+                        b = torch.minimum(lo + torch.tensor([dx, dy, dz], device=self.device), hi)
+                        occupied[b[:, 0], b[:, 1], b[:, 2]] = True
+        else:
+            occupied = torch.ones(n_bricks.tolist(), dtype=torch.bool, device=self.device)
+
+        bricks = occupied.nonzero()
+        self.brick_index.fill_(-1)
+        self.brick_index[occupied] = torch.arange(bricks.shape[0], dtype=torch.int32, device=self.device)
+
+        local = torch.stack(torch.meshgrid(*[torch.arange(B+1, device=self.device)]*3, indexing='ij'), -1).reshape(-1, 3)
+        pool = []
+        for brick_chunk in torch.split(bricks, chunk):
+            lattice = torch.minimum(brick_chunk[:, None] * B + local[None], cells).reshape(-1, 3)
+            sigma_feature, app_features = tensorf.compute_features(lattice / cells * 2 - 1)
+            pool.append(torch.cat((sigma_feature[:, None], app_features), -1).view(brick_chunk.shape[0], (B+1)**3, -1))
+        self.brick_pool = torch.cat(pool) if pool else self.brick_pool
+
+        print(f"baked {bricks.shape[0]}/{occupied.numel()} bricks, {self.brick_pool.numel() * 4 / 2**20:.1f} MB")
+
+    def lookup(self, xyz_sampled, channels):
+        # trilinear lookup of the pool channels inside the brick holding the sample, and whether that brick is baked
+        B = self.brick_size
+        cells = self.gridSize - 1
+        u = (xyz_sampled + 1) * 0.5 * cells
+        c = torch.minimum(torch.floor(u).long().clamp(min=0), cells - 1)
+        f = (u - c).clamp(0, 1)
+        b = torch.div(c, B, rounding_mode='floor')
+        l = c - b * B
+
+        brick = self.brick_index[b[:, 0], b[:, 1], b[:, 2]].long()
+        occupied = brick >= 0
+        pool = self.brick_pool.view(-1, self.brick_pool.shape[-1])[:, channels]
+        base = brick.clamp(min=0) * (B+1)**3
+
+        features = torch.zeros((xyz_sampled.shape[0], pool.shape[-1]), device=xyz_sampled.device)
+        for dx in (0, 1):
+            for dy in (0, 1):
+                for dz in (0, 1):
+                    w = (f[:, 0] if dx else 1 - f[:, 0]) * (f[:, 1] if dy else 1 - f[:, 1]) * (f[:, 2] if dz else 1 - f[:, 2])
+                    idx = ((l[:, 0] + dx) * (B+1) + l[:, 1] + dy) * (B+1) + l[:, 2] + dz
+                    features = features + w[:, None] * pool[base + idx]
+        return features, occupied
+
+    def compute_features(self, xyz_sampled):
+        # samples in empty bricks get no density
+        features, occupied = self.lookup(xyz_sampled, slice(None))
+        sigma_feature = torch.where(occupied, features[:, 0], torch.full_like(features[:, 0], -1e4))
+        app_features = features[:, 1:] * occupied[:, None]
+        return sigma_feature, app_features
+
+    def compute_densityfeature(self, xyz_sampled):
+        features, occupied = self.lookup(xyz_sampled, slice(0, 1))
+        return torch.where(occupied, features[:, 0], torch.full_like(features[:, 0], -1e4))
+
+    def compute_appfeature(self, xyz_sampled):
+        features, occupied = self.lookup(xyz_sampled, slice(1, None))
+        return features * occupied[:, None]
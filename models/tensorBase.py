@@ -2,18 +2,26 @@ import torch
 import torch.nn
 import torch.nn.functional as F
 from .sh import eval_sh_bases
+from dataLoader.ray_utils import sample_pdf
 import numpy as np
 import time
 
 
 def positional_encoding(positions, freqs):
     
-        freq_bands = (2**torch.arange(freqs).float()).to(positions.device)  # (F,)
+        freq_bands = (2**torch.arange(freqs).float()).to(positions)  # (F,)
         pts = (positions[..., None] * freq_bands).reshape(
             positions.shape[:-1] + (freqs * positions.shape[-1], ))  # (..., DF)
         pts = torch.cat([torch.sin(pts), torch.cos(pts)], dim=-1)
         return pts
 
+def autocast_dtype(device):
+    # dtype of the torch.autocast region the caller runs in on this device type, None outside of one
+    if device.type == 'cuda':
+        return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+    return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+
+
 def raw2alpha(sigma, dist):
     # sigma, dist  [N_rays, N_samples]
     alpha = 1. - torch.exp(-sigma*dist)
@@ -24,6 +32,21 @@ def raw2alpha(sigma, dist):
     return alpha, weights, T[:,-1:]
 
 
+def raw2alpha_packed(sigma, dist, ray_idx, N_rays):
+    # sigma, dist, ray_idx  [N_packed], samples sorted by ray and depth
+    alpha = 1. - torch.exp(-sigma*dist)
+
+    # per-ray exclusive cumprod of (1 - alpha), as a cumsum in log space restarted at the first sample of each ray
+    log_trans = torch.log(1. - alpha + 1e-10).double()
+    log_T = torch.cumsum(log_trans, 0) - log_trans
+    n_per_ray = torch.bincount(ray_idx, minlength=N_rays)
+    ray_start = torch.cumsum(n_per_ray, 0) - n_per_ray
+    T = torch.exp(log_T - log_T[ray_start[ray_idx]]).to(alpha.dtype)
+
+    weights = alpha * T  # [N_packed]
+    return alpha, weights
+
+
 def SHRender(xyz_sampled, viewdirs, features):
     sh_mult = eval_sh_bases(2, viewdirs)[:, None]
     rgb_sh = features.view(-1, 3, sh_mult.shape[-1])
@@ -36,26 +59,118 @@ def RGBRender(xyz_sampled, viewdirs, features):
     rgb = features
     return rgb
 
+def pack_bits(occupancy):
+    # bool tensor -> flat uint8 bits in np.packbits order (first value in the high bit, zero padded)
+    flat = occupancy.reshape(-1).to(torch.uint8)
+    flat = F.pad(flat, (0, -flat.numel() % 8)).view(-1, 8)
+    weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=flat.device)
+    return (flat * weights).sum(-1).to(torch.uint8)
+
+
+def unpack_bits(bits, n):
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=bits.device)
+    return ((bits[:, None] >> shifts) & 1).view(-1)[:n].bool()
+
+
+def lookup_bits(bits, idx):
+    return ((bits[idx >> 3] >> (7 - (idx & 7)).to(torch.uint8)) & 1).bool()
+
+
 class AlphaGridMask(torch.nn.Module):
-    def __init__(self, device, aabb, alpha_volume):
+    # bit-packed alpha lattice and cell occupancy, sample_alpha reads them with packed_lookup, else a float volume
+    def __init__(self, device, aabb, alpha_volume, levels=0, packed_lookup=False):
         super(AlphaGridMask, self).__init__()
         self.device = device
 
         self.aabb=aabb.to(self.device)
         self.aabbSize = self.aabb[1] - self.aabb[0]
         self.invgridSize = 1.0/self.aabbSize * 2
-        self.alpha_volume = alpha_volume.view(1,1,*alpha_volume.shape[-3:])
-        self.gridSize = torch.LongTensor([alpha_volume.shape[-1],alpha_volume.shape[-2],alpha_volume.shape[-3]]).to(self.device)
+        occupancy = alpha_volume.to(self.device).view(*alpha_volume.shape[-3:]) > 0
+        self.shape = tuple(occupancy.shape)
+        self.gridSize = torch.LongTensor([self.shape[2],self.shape[1],self.shape[0]]).to(self.device)
+        self.units = self.aabbSize / (self.gridSize-1)
+        self.bits = pack_bits(occupancy)
+
+        # a cell is occupied iff sample_alpha > 0 anywhere inside it
+        cells = F.max_pool3d(occupancy[None, None].float(), kernel_size=2, stride=1)
+        self.cell_bits = pack_bits(cells > 0)
+        self.packed_lookup = packed_lookup
+        self.alpha_volume = None if packed_lookup else occupancy[None, None].float()
+        self.mips = []
+        for level in range(1, levels + 1 if packed_lookup else 1):
+            size = 2 ** level
+            self.mips.append(F.max_pool3d(cells, kernel_size=size, stride=size, ceil_mode=True)[0, 0] > 0)
+
+    @classmethod
+    def from_bits(cls, device, aabb, bits, shape, levels=0, packed_lookup=False):
+        n = int(np.prod(shape))
+        return cls(device, aabb, unpack_bits(bits.to(device), n).view(*shape[-3:]), levels, packed_lookup)
+
+    def occupancy(self):
+        return unpack_bits(self.bits, int(np.prod(self.shape))).view(self.shape)
+
+    def cell_occupancy(self):
+        shape = [n - 1 for n in self.shape]
+        return unpack_bits(self.cell_bits, int(np.prod(shape))).view(shape)
+
+    def cell_occupied(self, idx):
+        # flat [Z-1, Y-1, X-1] cell indices
+        return lookup_bits(self.cell_bits, idx)
 
     def sample_alpha(self, xyz_sampled):
-        xyz_sampled = self.normalize_coord(xyz_sampled)
-        alpha_vals = F.grid_sample(self.alpha_volume, xyz_sampled.view(1,-1,1,1,3), align_corners=True).view(-1)
-
-        return alpha_vals
+        # [N] bool, True where trilinear sampling of the binary volume is > 0
+        if not self.packed_lookup:
+            xyz_sampled = self.normalize_coord(xyz_sampled.reshape(-1, 3))
+            return F.grid_sample(self.alpha_volume, xyz_sampled.view(1,-1,1,1,3), align_corners=True).view(-1) > 0
+        # the cell bit answers all points but occupied ones on cell faces or the border, which check their corners
+        pos = self.lattice_pos(xyz_sampled.reshape(-1, 3))
+        lo = torch.floor(pos)
+        face = (pos == lo).any(-1)
+        lo = lo.long()
+        cells = self.gridSize - 1
+        cell = torch.minimum(lo.clamp(min=0), cells - 1)
+        occupied = ((pos > -1) & (pos < self.gridSize)).all(-1)
+        if self.mips:
+            # points in empty coarse cells are done, the rest continues compacted
+            coarse = cell >> len(self.mips)
+            idx = torch.nonzero(occupied & self.mips[-1][coarse[:, 2], coarse[:, 1], coarse[:, 0]]).squeeze(1)
+            occupied = torch.zeros_like(occupied)
+            pos, lo, cell, face = pos[idx], lo[idx], cell[idx], face[idx]
+        else:
+            idx = None
+
+        hit = self.cell_occupied((cell[:, 2] * cells[1] + cell[:, 1]) * cells[0] + cell[:, 0])
+        if idx is None:
+            hit &= occupied
+        edge = torch.nonzero(hit & (face | (lo < 0).any(-1) | (lo >= cells).any(-1))).squeeze(1)
+        if edge.shape[0] > 0:
+            lo_e, step = lo[edge], (pos[edge] > lo[edge]).long()
+            corner_hit = torch.zeros_like(edge, dtype=torch.bool)
+            for corner in ((0,0,0), (1,0,0), (0,1,0), (1,1,0), (0,0,1), (1,0,1), (0,1,1), (1,1,1)):
+                c = lo_e + step * torch.tensor(corner, device=lo.device)
+                inside = ((c >= 0) & (c < self.gridSize)).all(-1)
+                c = torch.minimum(c.clamp(min=0), self.gridSize - 1)
+                flat = (c[:, 2] * self.gridSize[1] + c[:, 1]) * self.gridSize[0] + c[:, 0]
+                corner_hit |= inside & lookup_bits(self.bits, flat)
+            hit[edge] = corner_hit
+
+        if idx is None:
+            return hit
+        occupied[idx] = hit
+        return occupied
 
     def normalize_coord(self, xyz_sampled):
         return (xyz_sampled-self.aabb[0]) * self.invgridSize - 1
 
+    def lattice_pos(self, xyz_sampled):
+        # [N, 3] texel coordinates (x, y, z) the trilinear lookup reads at, lattice point i at i
+        return ((self.normalize_coord(xyz_sampled) + 1) / 2) * (self.gridSize - 1)
+
+    def exact_needed(self, xyz_sampled):
+        # points on cell faces or outside the lattice, whose cell does not answer the lookup
+        pos = self.lattice_pos(xyz_sampled)
+        return ((pos == torch.floor(pos)) | (pos < 0) | (pos > self.gridSize - 1)).any(-1)
+
 
 class MLPRender_Fea(torch.nn.Module):
     def __init__(self,inChanel, viewpe=6, feape=6, featureC=128):
@@ -140,7 +255,9 @@ class TensorBase(torch.nn.Module):
                     shadingMode = 'MLP_PE', alphaMask = None, near_far=[2.0,6.0],
                     density_shift = -10, alphaMask_thres=0.001, distance_scale=25, rayMarch_weight_thres=0.0001,
                     pos_pe = 6, view_pe = 6, fea_pe = 6, featureC=128, step_ratio=2.0,
-                    fea2denseAct = 'softplus'):
+                    fea2denseAct = 'softplus', occupancy_march=False, early_term_thres=0.0, early_term_segment=64,
+                    packed_samples=False, clip_samples=False, n_coarse=64, n_importance=0,
+                    fused_features=False, alpha_mask_levels=0, alpha_mask_packed=False):
         super(TensorBase, self).__init__()
 
         self.density_n_comp = density_n_comp
@@ -155,6 +272,22 @@ class TensorBase(torch.nn.Module):
         self.distance_scale = distance_scale
         self.rayMarch_weight_thres = rayMarch_weight_thres
         self.fea2denseAct = fea2denseAct
+        self.occupancy_march = occupancy_march
+        self.early_term_thres = early_term_thres
+        self.early_term_segment = early_term_segment
+        self.packed_samples = packed_samples
+        self.clip_samples = clip_samples
+        self.n_coarse = n_coarse
+        self.n_importance = n_importance
+        self.fused_features = fused_features
+        self.alpha_mask_levels = alpha_mask_levels
+        self.alpha_mask_packed = alpha_mask_packed
+        self.feature_dtype = torch.float32
+        # app_mask share of the valid samples, see track_samples
+        self.app_share = 1.0
+        self.sample_counts = None
+        self.fused_calls = 0
+        self._concat_cache = {}
 
         self.near_far = near_far
         self.step_ratio = step_ratio
@@ -207,7 +340,47 @@ class TensorBase(torch.nn.Module):
         pass
 
     def compute_features(self, xyz_sampled):
-        pass
+        # density and appearance features of the same samples, models override this with a fused gather
+        return self.compute_densityfeature(xyz_sampled), self.compute_appfeature(xyz_sampled)
+
+    # the fused gather only pays off when nearly all valid samples need appearance
+    fused_min_app_share = 0.9
+    fused_share_every = 16
+
+    def valid_features(self, xyz_valid):
+        # density features of the valid samples, plus their appearance features when fused (None otherwise)
+        if self.fused_features and self.app_share >= self.fused_min_app_share:
+            return self.compute_features(xyz_valid)
+        return self.compute_densityfeature(xyz_valid), None
+
+    def track_samples(self, n_slots, n_valid, n_app):
+        # counts of the last forward, kept on the device. app_share is read back every fused_share_every forwards
+        self.sample_counts = (n_slots, n_valid, n_app)
+        if self.fused_features:
+            self.fused_calls += 1
+            if self.fused_calls % self.fused_share_every == 0:
+                self.app_share = float(n_app) / max(float(n_valid), 1)
+
+    def sample_shares(self):
+        # (valid, app_mask) samples per sample slot in the last forward, None before the first one
+        if self.sample_counts is None:
+            return None
+        n_slots, n_valid, n_app = [float(n) for n in self.sample_counts]
+        if self.fused_features and self.app_share >= self.fused_min_app_share:
+            n_app = n_valid
+        return n_valid / max(n_slots, 1), n_app / max(n_slots, 1)
+
+    def concat_grids(self, key, *grids):
+        # torch.cat of the grids along channels, cached while rendering
+        if torch.is_grad_enabled():
+            self._concat_cache.clear()
+            return torch.cat(grids, 1)
+        state = [(g.data_ptr(), g._version, g.dtype) for g in grids]
+        cached = self._concat_cache.get(key)
+        if cached is None or len(cached[0]) != len(grids) or any(a is not b for a, b in zip(cached[0], grids)) or cached[1] != state:
+            cached = (grids, state, torch.cat(grids, 1))
+            self._concat_cache[key] = cached
+        return cached[2]
     
     def compute_densityfeature(self, xyz_sampled):
         pass
@@ -218,6 +391,22 @@ class TensorBase(torch.nn.Module):
     def normalize_coord(self, xyz_sampled):
         return (xyz_sampled-self.aabb[0]) * self.invaabbSize - 1
 
+    def set_feature_dtype(self, dtype):
+        # features and MLP in dtype, densities and colors come back in fp32 for compositing
+        self.feature_dtype = dtype
+        self.to(dtype)
+
+    def shade(self, xyz_sampled, viewdirs, app_features):
+        if autocast_dtype(xyz_sampled.device) is None:
+            dtype = self.feature_dtype
+            xyz_sampled, viewdirs, app_features = xyz_sampled.to(dtype), viewdirs.to(dtype), app_features.to(dtype)
+        return self.renderModule(xyz_sampled, viewdirs, app_features).float()
+
+    def amp_features(self, *features):
+        # under autocast the appearance products, basis_mat and renderModule run in the autocast dtype
+        dtype = autocast_dtype(features[0].device)
+        return features if dtype is None else tuple(f.to(dtype) for f in features)
+
     def get_optparam_groups(self, lr_init_spatial = 0.02, lr_init_network = 0.001):
         pass
 
@@ -234,6 +423,16 @@ class TensorBase(torch.nn.Module):
             'distance_scale': self.distance_scale,
             'rayMarch_weight_thres': self.rayMarch_weight_thres,
             'fea2denseAct': self.fea2denseAct,
+            'occupancy_march': self.occupancy_march,
+            'early_term_thres': self.early_term_thres,
+            'early_term_segment': self.early_term_segment,
+            'packed_samples': self.packed_samples,
+            'clip_samples': self.clip_samples,
+            'n_coarse': self.n_coarse,
+            'n_importance': self.n_importance,
+            'fused_features': self.fused_features,
+            'alpha_mask_levels': self.alpha_mask_levels,
+            'alpha_mask_packed': self.alpha_mask_packed,
 
             'near_far': self.near_far,
             'step_ratio': self.step_ratio,
@@ -245,21 +444,23 @@ class TensorBase(torch.nn.Module):
             'featureC': self.featureC
         }
 
-    def save(self, path):
+    def get_ckpt(self):
         kwargs = self.get_kwargs()
         ckpt = {'kwargs': kwargs, 'state_dict': self.state_dict()}
         if self.alphaMask is not None:
-            alpha_volume = self.alphaMask.alpha_volume.bool().cpu().numpy()
-            ckpt.update({'alphaMask.shape':alpha_volume.shape})
-            ckpt.update({'alphaMask.mask':np.packbits(alpha_volume.reshape(-1))})
+            ckpt.update({'alphaMask.shape':(1, 1, *self.alphaMask.shape)})
+            ckpt.update({'alphaMask.mask':self.alphaMask.bits.cpu().numpy()})
             ckpt.update({'alphaMask.aabb': self.alphaMask.aabb.cpu()})
-        torch.save(ckpt, path)
+        return ckpt
+
+    def save(self, path):
+        torch.save(self.get_ckpt(), path)
 
     def load(self, ckpt):
         if 'alphaMask.aabb' in ckpt.keys():
-            length = np.prod(ckpt['alphaMask.shape'])
-            alpha_volume = torch.from_numpy(np.unpackbits(ckpt['alphaMask.mask'])[:length].reshape(ckpt['alphaMask.shape']))
-            self.alphaMask = AlphaGridMask(self.device, ckpt['alphaMask.aabb'].to(self.device), alpha_volume.float().to(self.device))
+            self.alphaMask = AlphaGridMask.from_bits(self.device, ckpt['alphaMask.aabb'].to(self.device), torch.from_numpy(ckpt['alphaMask.mask']),
+                                                     ckpt['alphaMask.shape'], self.alpha_mask_levels,
+                                                     self.alpha_mask_packed)
         self.load_state_dict(ckpt['state_dict'])
 
 
@@ -295,12 +496,313 @@ class TensorBase(torch.nn.Module):
 
         return rays_pts, interpx, ~mask_outbbox
 
+    def intersect_aabb(self, rays_o, rays_d):
+        # entry (clamped to near_far, as in sample_ray) and exit distances of the rays through the aabb
+        near, far = self.near_far
+        vec = torch.where(rays_d==0, torch.full_like(rays_d, 1e-6), rays_d)
+        rate_a = (self.aabb[1] - rays_o) / vec
+        rate_b = (self.aabb[0] - rays_o) / vec
+        t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(min=near, max=far)
+        t_max = torch.maximum(rate_a, rate_b).amin(-1)
+        return t_min, t_max
+
+    def clip_n_samples(self, rays_o, rays_d, N_samples=-1):
+        # number of sample_ray samples needed to reach the aabb exit of the longest ray
+        N_samples = N_samples if N_samples>0 else self.nSamples
+        t_min, t_max = self.intersect_aabb(rays_o, rays_d)
+        n = torch.floor((t_max - t_min) / self.stepSize).long() + 1
+        return int(n.clamp(1, N_samples).max().item()) if n.numel() > 0 else 1
+
+    def sample_ray_clipped(self, rays_o, rays_d, is_train=True, N_samples=-1):
+        # sample_ray up to each ray's own aabb exit, returns packed samples (ray index, sample index, depth)
+        N_samples = N_samples if N_samples>0 else self.nSamples
+        t_min, t_max = self.intersect_aabb(rays_o, rays_d)
+        jitter = torch.rand_like(t_min) if is_train else torch.zeros_like(t_min)
+
+        counts = torch.floor((t_max - t_min) / self.stepSize - jitter).long() + 1
+        counts = counts.clamp(0, N_samples)
+        ray_idx = torch.repeat_interleave(torch.arange(rays_o.shape[0], device=rays_o.device), counts)
+        ray_start = torch.cumsum(counts, 0) - counts
+        k = torch.arange(ray_idx.shape[0], device=rays_o.device) - ray_start[ray_idx]
+        z_vals = t_min[ray_idx] + self.stepSize * (k + jitter[ray_idx])
+
+        rays_pts = rays_o[ray_idx] + rays_d[ray_idx] * z_vals[:, None]
+        inbbox = ((self.aabb[0] <= rays_pts) & (rays_pts <= self.aabb[1])).all(dim=-1)
+
+        return ray_idx[inbbox], k[inbbox], z_vals[inbbox]
+
+    def march_ray(self, rays_o, rays_d, is_train=True, N_samples=-1):
+        # sample_ray positions in occupied alpha mask cells only, returns packed samples (ray index, sample index, depth)
+        N_samples = N_samples if N_samples>0 else self.nSamples
+        stepsize = self.stepSize
+        mask = self.alphaMask
+        N_rays = rays_o.shape[0]
+
+        vec = torch.where(rays_d==0, torch.full_like(rays_d, 1e-6), rays_d)
+        t_min, t_max = self.intersect_aabb(rays_o, rays_d)
+
+        jitter = torch.rand_like(t_min) if is_train else torch.zeros_like(t_min)
+        rate_a = (mask.aabb[1] - rays_o) / vec
+        rate_b = (mask.aabb[0] - rays_o) / vec
+        t_enter = torch.maximum(torch.minimum(rate_a, rate_b).amax(-1), t_min)
+        t_exit = torch.minimum(torch.maximum(rate_a, rate_b).amin(-1), t_max)
+        t_exit = torch.maximum(t_exit, t_enter)
+
+        # ray in the mask lattice coordinates, cell i spans [i, i+1]
+        o = (rays_o - mask.aabb[0]) / mask.units
+        d = vec / mask.units
+        cells = mask.gridSize - 1
+
+        # DDA: every step each ray moves to its next plane crossing, so crossings come out sorted
+        p_in, p_out = o + d * t_enter[:, None], o + d * t_exit[:, None]
+        lo = torch.maximum(torch.floor(torch.minimum(p_in, p_out)) + 1, torch.ones_like(o))
+        hi = torch.minimum(torch.ceil(torch.maximum(p_in, p_out)) - 1, (cells - 1).to(o.dtype))
+        left = (hi - lo + 1).clamp(min=0).long()
+        forward = d > 0
+        plane = torch.where(forward, lo, hi)
+        step = torch.where(forward, torch.ones_like(o), -torch.ones_like(o))
+        crossings = [t_enter]
+        for _ in range(int(left.sum(-1).max().item()) if N_rays > 0 else 0):
+            t_next = torch.where(left > 0, (plane - o) / d, torch.full_like(o, float('inf')))
+            t_hit, axis = t_next.min(-1)
+            crossings.append(t_hit)
+            hit = F.one_hot(axis, 3).bool() & (left > 0)
+            plane = plane + step * hit
+            left = left - hit.long()
+        crossings.append(t_exit)
+        bounds = torch.minimum(torch.maximum(torch.stack(crossings, -1), t_enter[:, None]), t_exit[:, None])
+        t_lo, t_hi = bounds[:, :-1], bounds[:, 1:]
+
+        idx = torch.floor(o[:, None] + d[:, None] * (0.5 * (t_lo + t_hi))[..., None]).long()
+        idx = torch.minimum(idx.clamp(min=0), cells - 1)
+        idx = (idx[..., 2] * cells[1] + idx[..., 1]) * cells[0] + idx[..., 0]
+        occupied = mask.cell_occupied(idx)
+
+        # lattice samples t_k = t_min + stepsize * (k + jitter) inside [t_lo, t_hi)
+        k_lo = torch.ceil((t_lo - t_min[:, None]) / stepsize - jitter[:, None]).long().clamp(0, N_samples)
+        k_hi = torch.ceil((t_hi - t_min[:, None]) / stepsize - jitter[:, None]).long().clamp(0, N_samples)
+        counts = torch.where(occupied, (k_hi - k_lo).clamp(min=0), torch.zeros_like(k_lo)).view(-1)
+        seg_valid = counts > 0
+        counts, k_lo = counts[seg_valid], k_lo.view(-1)[seg_valid]
+        seg_ray = torch.arange(N_rays, device=rays_o.device)[:, None].expand(t_lo.shape).reshape(-1)[seg_valid]
+
+        ray_idx = torch.repeat_interleave(seg_ray, counts)
+        seg_start = torch.cumsum(counts, 0) - counts
+        k = torch.repeat_interleave(k_lo - seg_start, counts) + torch.arange(ray_idx.shape[0], device=rays_o.device)
+        z_vals = t_min[ray_idx] + stepsize * (k + jitter[ray_idx])
+
+        # drop samples that only touch the aabb through rounding, exactly as sample_ray does
+        rays_pts = rays_o[ray_idx] + rays_d[ray_idx] * z_vals[:, None]
+        keep = ((self.aabb[0] <= rays_pts) & (rays_pts <= self.aabb[1])).all(dim=-1)
+
+        # samples on cell faces or the lattice border are checked against the mask itself
+        exact = torch.nonzero(keep & mask.exact_needed(rays_pts)).squeeze(1)
+        if exact.shape[0] > 0:
+            keep[exact] = mask.sample_alpha(rays_pts[exact])
+
+        return ray_idx[keep], k[keep], z_vals[keep]
+
+    def sample_ray_occupancy(self, rays_o, rays_d, is_train=True, N_samples=-1):
+        # pads the marched samples back into [N_rays, N_max] tensors, N_max being the longest occupied run in the chunk
+        N_samples = N_samples if N_samples>0 else self.nSamples
+        N_rays = rays_o.shape[0]
+        ray_idx, k, z = self.march_ray(rays_o, rays_d, is_train=is_train, N_samples=N_samples)
+
+        n_per_ray = torch.bincount(ray_idx, minlength=N_rays)
+        N_max = max(int(n_per_ray.max().item()), 1) if N_rays > 0 else 1
+        ray_start = torch.cumsum(n_per_ray, 0) - n_per_ray
+        pos = torch.arange(ray_idx.shape[0], device=rays_o.device) - ray_start[ray_idx]
+
+        z_vals = torch.zeros((N_rays, N_max), device=rays_o.device)
+        dists = torch.zeros((N_rays, N_max), device=rays_o.device)
+        ray_valid = torch.zeros((N_rays, N_max), dtype=torch.bool, device=rays_o.device)
+        z_vals[ray_idx, pos] = z
+        # skipped samples carry no density, so each kept sample still spans one step (except the last lattice sample)
+        dists[ray_idx, pos] = torch.where(k < N_samples - 1, self.stepSize, torch.zeros_like(self.stepSize)).to(z)
+        ray_valid[ray_idx, pos] = True
+
+        rays_pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,None]
+        return rays_pts, z_vals, ray_valid, dists
+
+
+    @torch.no_grad()
+    def sample_ray_importance(self, rays_o, rays_d, is_train=True, ndc_ray=False):
+        # hierarchical sampling: n_importance samples drawn from the weights of a density-only coarse pass
+        N_rays = rays_o.shape[0]
+        if ndc_ray:
+            xyz_coarse, z_coarse, ray_valid = self.sample_ray_ndc(rays_o, rays_d, is_train=is_train, N_samples=self.n_coarse)
+            z_coarse = z_coarse.expand(ray_valid.shape)
+        else:
+            t_min, t_max = self.intersect_aabb(rays_o, rays_d)
+            t_max = torch.maximum(t_max, t_min)
+            rng = torch.arange(self.n_coarse, device=rays_o.device)[None].float()
+            rng = rng + (torch.rand((N_rays, self.n_coarse), device=rays_o.device) if is_train else 0.5)
+            z_coarse = t_min[:, None] + (t_max - t_min)[:, None] * rng / self.n_coarse
+            xyz_coarse = rays_o[..., None, :] + rays_d[..., None, :] * z_coarse[..., None]
+            ray_valid = ~((self.aabb[0] > xyz_coarse) | (xyz_coarse > self.aabb[1])).any(dim=-1)
+
+        dists = torch.cat((z_coarse[:, 1:] - z_coarse[:, :-1], torch.zeros_like(z_coarse[:, :1])), dim=-1)
+        if ndc_ray:
+            dists = dists * torch.norm(rays_d, dim=-1, keepdim=True)
+        alpha = self.compute_alpha(xyz_coarse.view(-1, 3), (dists * self.distance_scale).view(-1)).view(ray_valid.shape)
+        alpha = alpha * ray_valid
+        T = torch.cumprod(torch.cat([torch.ones_like(alpha[:, :1]), 1. - alpha + 1e-10], -1), -1)
+        weight = alpha * T[:, :-1]
+
+        z_mid = 0.5 * (z_coarse[:, 1:] + z_coarse[:, :-1])
+        z_vals = sample_pdf(z_mid, weight[:, 1:-1], self.n_importance, det=not is_train)
+        z_vals = torch.sort(z_vals, -1)[0]
+
+        rays_pts = rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., None]
+        mask_outbbox = ((self.aabb[0] > rays_pts) | (rays_pts > self.aabb[1])).any(dim=-1)
+        return rays_pts, z_vals, ~mask_outbbox
+
+    def sample_ray_packed(self, rays_o, rays_d, is_train=True, ndc_ray=False, N_samples=-1):
+        # flat sample buffer: ray index (sorted by ray, then depth), position, depth and step length of every kept sample
+        N_samples = N_samples if N_samples>0 else self.nSamples
+        marched = self.occupancy_march and self.alphaMask is not None
+        if (marched or self.clip_samples) and not ndc_ray:
+            if marched:
+                ray_idx, k, z_vals = self.march_ray(rays_o, rays_d, is_train=is_train, N_samples=N_samples)
+            else:
+                ray_idx, k, z_vals = self.sample_ray_clipped(rays_o, rays_d, is_train=is_train, N_samples=N_samples)
+            dists = torch.where(k < N_samples - 1, self.stepSize, torch.zeros_like(self.stepSize)).to(z_vals)
+            xyz_sampled = rays_o[ray_idx] + rays_d[ray_idx] * z_vals[:, None]
+
+            if not marched and self.alphaMask is not None:
+                alpha_mask = self.alphaMask.sample_alpha(xyz_sampled) > 0
+                ray_idx, xyz_sampled, z_vals, dists = ray_idx[alpha_mask], xyz_sampled[alpha_mask], z_vals[alpha_mask], dists[alpha_mask]
+            return ray_idx, xyz_sampled, z_vals, dists
+
+        if ndc_ray:
+            xyz_sampled, z_vals, ray_valid = self.sample_ray_ndc(rays_o, rays_d, is_train=is_train, N_samples=N_samples)
+            dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+            dists = dists * torch.norm(rays_d, dim=-1, keepdim=True)
+        else:
+            xyz_sampled, z_vals, ray_valid = self.sample_ray(rays_o, rays_d, is_train=is_train, N_samples=N_samples)
+            dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+        z_vals = z_vals.expand(ray_valid.shape)
+
+        if self.alphaMask is not None:
+            alpha_mask = self.alphaMask.sample_alpha(xyz_sampled[ray_valid]) > 0
+            ray_invalid = ~ray_valid
+            ray_invalid[ray_valid] |= (~alpha_mask)
+            ray_valid = ~ray_invalid
+        ray_idx = ray_valid.nonzero()[:, 0]
+        return ray_idx, xyz_sampled[ray_valid], z_vals[ray_valid], dists[ray_valid]
 
     def shrink(self, new_aabb, voxel_size):
         pass
 
+    @torch.no_grad()
+    def swap_param(self, optimizer, old, new, resample):
+        # moves the optimizer state of old to the new Parameter, resampling the tensors shaped like it
+        if optimizer is None:
+            return new
+        for group in optimizer.param_groups:
+            group['params'] = [new if p is old else p for p in group['params']]
+        state = optimizer.state.pop(old, None)
+        if state is not None:
+            optimizer.state[new] = {k: resample(v) if torch.is_tensor(v) and v.shape == old.shape else v
+                                    for k, v in state.items()}
+        return new
+
+    @staticmethod
+    def texel_range(lo, hi, n):
+        # texels [i0, i1) interpolation can read in [lo, hi], padded by one
+        i0 = int(np.floor((lo + 1) / 2 * (n - 1))) - 1
+        i1 = int(np.ceil((hi + 1) / 2 * (n - 1))) + 2
+        return min(max(i0, 0), n - 1), min(max(i1, 1), n)
+
+    def density_bound(self, lo, hi):
+        # upper bound of the density feature in the normalized box [lo, hi], None if unknown
+        return None
+
+    @torch.no_grad()
+    def mask_occupancy(self, axes):
+        # [Z, Y, X] bool of the lattice points where the current alpha mask samples > 0
+        mask = self.alphaMask
+        occ = mask.occupancy()
+        for i, dim in ((0, 2), (1, 1), (2, 0)):
+            n = occ.shape[dim]
+            coord = (axes[i] - mask.aabb[0][i]) * mask.invgridSize[i] - 1
+            pos = ((coord + 1) / 2) * (n - 1)
+            lo = torch.floor(pos)
+            hi = (lo + (pos > lo).float()).long().clamp(-1, n) + 1
+            lo = lo.long().clamp(-1, n) + 1
+            pad = [0, 0] * (2 - dim) + [1, 1]
+            occ = F.pad(occ[None].float(), pad)[0] > 0
+            occ = occ.index_select(dim, lo) | occ.index_select(dim, hi)
+        return occ
+
+    @torch.no_grad()
+    def dense_alpha(self, gridSize=None, zyx=False, block=64, skip_thres=0.0, band=-1):
+        # alpha on the lattice, evaluated in blocks that skip empty mask blocks; band >= 0 only evaluates the mask grown by band
+        gridSize = [int(n) for n in (self.gridSize if gridSize is None else gridSize)]
+        lin = [torch.linspace(0, 1, n).to(self.device) for n in gridSize]
+        axes = [self.aabb[0][i] * (1 - lin[i]) + self.aabb[1][i] * lin[i] for i in range(3)]
+        if band >= 0 and self.alphaMask is not None:
+            return self.sparse_alpha(axes, zyx, block**3, band)
+        norm = [((axes[i] - self.aabb[0][i]) * self.invaabbSize[i] - 1).tolist() for i in range(3)]
+        if self.alphaMask is not None:
+            mask = self.alphaMask
+            mask_norm = [((axes[i] - mask.aabb[0][i]) * mask.invgridSize[i] - 1).tolist() for i in range(3)]
+            mask_size = mask.shape[::-1]
+            mask_occ = mask.occupancy()
+
+        blocks, keep = [], []
+        for i0 in range(0, gridSize[0], block):
+            for j0 in range(0, gridSize[1], block):
+                for k0 in range(0, gridSize[2], block):
+                    b = (i0, min(i0 + block, gridSize[0]), j0, min(j0 + block, gridSize[1]), k0, min(k0 + block, gridSize[2]))
+                    flag = torch.ones((), dtype=torch.bool, device=self.device)
+                    if self.alphaMask is not None:
+                        (x0, x1), (y0, y1), (z0, z1) = [self.texel_range(mask_norm[a][b[2*a]], mask_norm[a][b[2*a+1]-1], mask_size[a]) for a in range(3)]
+                        flag = flag & mask_occ[z0:z1, y0:y1, x0:x1].any()
+                    if skip_thres > 0:
+                        bound = self.density_bound([norm[a][b[2*a]] for a in range(3)], [norm[a][b[2*a+1]-1] for a in range(3)])
+                        if bound is not None:
+                            # a little slack for the rounding of the interpolation and the low precision features
+                            sigma = self.feature2density(bound.float().reshape(1) * 1.001 + 1e-6)
+                            flag = flag & (1 - torch.exp(-sigma * self.stepSize)[0] >= skip_thres)
+                    blocks.append(b)
+                    keep.append(flag)
+        keep = torch.stack(keep).tolist()
+
+        alpha = torch.zeros(gridSize[::-1] if zyx else gridSize, device=self.device)
+        for (i0, i1, j0, j1, k0, k1), flag in zip(blocks, keep):
+            if not flag:
+                continue
+            if zyx:
+                z, y, x = torch.meshgrid(axes[2][k0:k1], axes[1][j0:j1], axes[0][i0:i1], indexing='ij')
+                alpha[k0:k1, j0:j1, i0:i1] = self.compute_alpha(torch.stack((x, y, z), -1).view(-1, 3), self.stepSize).view(x.shape)
+            else:
+                x, y, z = torch.meshgrid(axes[0][i0:i1], axes[1][j0:j1], axes[2][k0:k1], indexing='ij')
+                alpha[i0:i1, j0:j1, k0:k1] = self.compute_alpha(torch.stack((x, y, z), -1).view(-1, 3), self.stepSize).view(x.shape)
+        return alpha
+
+    @torch.no_grad()
+    def sparse_alpha(self, axes, zyx, chunk, band):
+        occ = self.mask_occupancy(axes)
+        if band > 0:
+            occ = F.max_pool3d(occ[None, None].float(), kernel_size=2*band+1, padding=band, stride=1)[0, 0] > 0
+        idx = torch.nonzero(occ)
+        alpha = torch.zeros(occ.shape if zyx else occ.shape[::-1], device=self.device)
+        for start in range(0, idx.shape[0], chunk):
+            iz, iy, ix = idx[start:start+chunk].unbind(-1)
+            xyz = torch.stack((axes[0][ix], axes[1][iy], axes[2][iz]), -1)
+            # no alpha mask test, the band lies outside of it
+            sigma = self.feature2density(self.compute_densityfeature(self.normalize_coord(xyz)))
+            values = 1 - torch.exp(-sigma*self.stepSize)
+            if zyx:
+                alpha[iz, iy, ix] = values
+            else:
+                alpha[ix, iy, iz] = values
+        return alpha
+
     @torch.no_grad()
     def getDenseAlpha(self,gridSize=None):
+        # alpha [X, Y, Z] with its lattice points [X, Y, Z, 3], dense_alpha alone skips building the points
         gridSize = self.gridSize if gridSize is None else gridSize
 
         samples = torch.stack(torch.meshgrid(
@@ -309,23 +811,16 @@ class TensorBase(torch.nn.Module):
             torch.linspace(0, 1, gridSize[2]),
         ), -1).to(self.device)
         dense_xyz = self.aabb[0] * (1-samples) + self.aabb[1] * samples
-
-        # dense_xyz = dense_xyz
-        # print(self.stepSize, self.distance_scale*self.aabbDiag)
-        # computes the mask that prunes the model (How?)
-        alpha = torch.zeros_like(dense_xyz[...,0])
-        for i in range(gridSize[0]):
-            alpha[i] = self.compute_alpha(dense_xyz[i].view(-1,3), self.stepSize).view((gridSize[1], gridSize[2]))
-        return alpha, dense_xyz
+        return self.dense_alpha(gridSize), dense_xyz
 
     # triggered every thousand training iterations
     # reduce model size
     @torch.no_grad()
-    def updateAlphaMask(self, gridSize=(200,200,200)):
+    def updateAlphaMask(self, gridSize=(200,200,200), band=-1):
 
-        alpha, dense_xyz = self.getDenseAlpha(gridSize)
-        dense_xyz = dense_xyz.transpose(0,2).contiguous()
-        alpha = alpha.clamp(0,1).transpose(0,2).contiguous()[None,None]
+        # values under alphaMask_thres are skipped, they end up 0 anyway
+        alpha = self.dense_alpha(gridSize, zyx=True, skip_thres=self.alphaMask_thres, band=band)
+        alpha = alpha.clamp(0,1)[None,None]
         total_voxels = gridSize[0] * gridSize[1] * gridSize[2]
 
         ks = 3
@@ -333,12 +828,16 @@ class TensorBase(torch.nn.Module):
         alpha[alpha>=self.alphaMask_thres] = 1
         alpha[alpha<self.alphaMask_thres] = 0
 
-        self.alphaMask = AlphaGridMask(self.device, self.aabb, alpha)
+        self.alphaMask = AlphaGridMask(self.device, self.aabb, alpha, self.alpha_mask_levels, self.alpha_mask_packed)
 
-        valid_xyz = dense_xyz[alpha>0.5]
+        # bbox of the kept lattice points, per axis from the coordinates of the occupied slices
+        valid = alpha > 0.5
+        occupied = [valid.any(1).any(0), valid.any(2).any(0), valid.any(2).any(1)]
+        lin = [torch.linspace(0, 1, n).to(self.device) for n in gridSize]
+        axes = [(self.aabb[0][i] * (1 - lin[i]) + self.aabb[1][i] * lin[i])[occupied[i]] for i in range(3)]
 
-        xyz_min = valid_xyz.amin(0)
-        xyz_max = valid_xyz.amax(0)
+        xyz_min = torch.stack([a.amin(0) for a in axes])
+        xyz_max = torch.stack([a.amax(0) for a in axes])
 
         new_aabb = torch.stack((xyz_min, xyz_max))
 
@@ -347,14 +846,12 @@ class TensorBase(torch.nn.Module):
         return new_aabb
 
     @torch.no_grad()
-    def filtering_rays(self, all_rays, all_rgbs, N_samples=256, chunk=10240*5, bbox_only=False):
-        print('========> filtering rays ...')
-        tt = time.time()
-
+    def filtering_mask(self, all_rays, N_samples=256, chunk=10240*5, bbox_only=False):
+        # [N] bool mask (on the device of all_rays) of the rays that hit the aabb, or the alpha mask
         N = torch.tensor(all_rays.shape[:-1]).prod()
 
         mask_filtered = []
-        idx_chunks = torch.split(torch.arange(N), chunk)
+        idx_chunks = torch.split(torch.arange(N, device=all_rays.device), chunk)
         for idx_chunk in idx_chunks:
             rays_chunk = all_rays[idx_chunk].to(self.device)
 
@@ -371,15 +868,25 @@ class TensorBase(torch.nn.Module):
                 xyz_sampled, _,_ = self.sample_ray(rays_o, rays_d, N_samples=N_samples, is_train=False)
                 mask_inbbox= (self.alphaMask.sample_alpha(xyz_sampled).view(xyz_sampled.shape[:-1]) > 0).any(-1)
 
-            mask_filtered.append(mask_inbbox.cpu())
+            mask_filtered.append(mask_inbbox.to(all_rays.device))
 
-        mask_filtered = torch.cat(mask_filtered).view(all_rgbs.shape[:-1])
+        return torch.cat(mask_filtered)
+
+    def filtering_rays(self, all_rays, all_rgbs, N_samples=256, chunk=10240*5, bbox_only=False, return_mask=False):
+        print('========> filtering rays ...')
+        tt = time.time()
+
+        N = torch.tensor(all_rays.shape[:-1]).prod()
+        mask_filtered = self.filtering_mask(all_rays, N_samples=N_samples, chunk=chunk, bbox_only=bbox_only).view(all_rgbs.shape[:-1])
 
         print(f'Ray filtering done! takes {time.time()-tt} s. ray mask ratio: {torch.sum(mask_filtered) / N}')
+        if return_mask:
+            return all_rays[mask_filtered], all_rgbs[mask_filtered], mask_filtered
         return all_rays[mask_filtered], all_rgbs[mask_filtered]
 
 
     def feature2density(self, density_features):
+        density_features = density_features.float()
         if self.fea2denseAct == "softplus":
             return F.softplus(density_features+self.density_shift)
         elif self.fea2denseAct == "relu":
@@ -409,22 +916,119 @@ class TensorBase(torch.nn.Module):
         return alpha
 
 
+    def composite_segments(self, xyz_sampled, viewdirs, dists, ray_valid):
+        # early ray termination, segments stop being evaluated for rays with transmittance below early_term_thres
+        N_rays, N_samples = ray_valid.shape
+        weight = torch.zeros(ray_valid.shape, device=xyz_sampled.device)
+        rgb = torch.zeros((N_rays, N_samples, 3), device=xyz_sampled.device)
+        T = torch.ones(N_rays, device=xyz_sampled.device)
+        active = torch.arange(N_rays, device=xyz_sampled.device)
+
+        n_app = torch.zeros((), dtype=torch.long, device=xyz_sampled.device)
+        for start in range(0, N_samples, self.early_term_segment):
+            end = min(start + self.early_term_segment, N_samples)
+            valid = ray_valid[active, start:end]
+            xyz_seg = xyz_sampled[active, start:end]
+
+            sigma = torch.zeros(valid.shape, device=xyz_sampled.device)
+            if valid.any():
+                sigma_feature, valid_app_features = self.valid_features(xyz_seg[valid])
+                sigma[valid] = self.feature2density(sigma_feature)
+
+            alpha, weight_seg, T_seg = raw2alpha(sigma, dists[active, start:end] * self.distance_scale)
+            weight_seg = weight_seg * T[active, None]
+            weight[active, start:end] = weight_seg
+
+            app_mask = weight_seg > self.rayMarch_weight_thres
+            n_app = n_app + app_mask.sum()
+            if app_mask.any():
+                rgb_seg = torch.zeros((*valid.shape, 3), device=xyz_sampled.device)
+                if valid_app_features is not None:
+                    app_features = valid_app_features[app_mask[valid]]
+                else:
+                    app_features = self.compute_appfeature(xyz_seg[app_mask])
+                rgb_seg[app_mask] = self.shade(xyz_seg[app_mask], viewdirs[active, start:end][app_mask], app_features)
+                rgb[active, start:end] = rgb_seg
+
+            T[active] = T[active] * T_seg[:, 0]
+            active = active[T[active] > self.early_term_thres]
+            if active.numel() == 0:
+                break
+
+        self.track_samples(ray_valid.numel(), ray_valid.sum(), n_app)
+        return weight, rgb
+
+
+    def forward_packed(self, rays_chunk, white_bg=True, is_train=False, ndc_ray=False, N_samples=-1):
+        # same as forward, but every per-sample tensor only holds the samples that survive the masks
+        N_rays = rays_chunk.shape[0]
+        viewdirs = rays_chunk[:, 3:6]
+        ray_idx, xyz_sampled, z_vals, dists = self.sample_ray_packed(rays_chunk[:, :3], viewdirs, is_train=is_train,
+                                                                     ndc_ray=ndc_ray, N_samples=N_samples)
+        if ndc_ray:
+            viewdirs = viewdirs / torch.norm(viewdirs, dim=-1, keepdim=True)
+
+        sigma = torch.zeros_like(z_vals)
+        if ray_idx.numel() > 0:
+            xyz_sampled = self.normalize_coord(xyz_sampled)
+            sigma_feature, valid_app_features = self.valid_features(xyz_sampled)
+            sigma = self.feature2density(sigma_feature)
+
+        alpha, weight = raw2alpha_packed(sigma, dists * self.distance_scale, ray_idx, N_rays)
+
+        app_mask = weight > self.rayMarch_weight_thres
+        self.track_samples(N_rays * (N_samples if N_samples > 0 else self.nSamples), ray_idx.shape[0], app_mask.sum())
+        rgb_map = torch.zeros((N_rays, 3), device=rays_chunk.device)
+        if app_mask.any():
+            xyz_app, ray_app = xyz_sampled[app_mask], ray_idx[app_mask]
+            app_features = valid_app_features[app_mask] if valid_app_features is not None else self.compute_appfeature(xyz_app)
+            valid_rgbs = self.shade(xyz_app, viewdirs[ray_app], app_features)
+            rgb_map = rgb_map.index_add(0, ray_app, weight[app_mask, None] * valid_rgbs)
+
+        acc_map = torch.zeros(N_rays, device=rays_chunk.device).index_add(0, ray_idx, weight)
+
+        if white_bg or (is_train and torch.rand((1,))<0.5):
+            rgb_map = rgb_map + (1. - acc_map[..., None])
+
+        rgb_map = rgb_map.clamp(0,1)
+
+        with torch.no_grad():
+            depth_map = torch.zeros(N_rays, device=rays_chunk.device).index_add(0, ray_idx, weight * z_vals)
+            depth_map = depth_map + (1. - acc_map) * rays_chunk[..., -1]
+
+        return rgb_map, depth_map
+
     def forward(self, rays_chunk, white_bg=True, is_train=False, ndc_ray=False, N_samples=-1):
 
+        if self.packed_samples and self.n_importance == 0:
+            return self.forward_packed(rays_chunk, white_bg=white_bg, is_train=is_train, ndc_ray=ndc_ray, N_samples=N_samples)
+
         # sample points
         viewdirs = rays_chunk[:, 3:6]
-        if ndc_ray:
+        marched = self.occupancy_march and self.alphaMask is not None and not ndc_ray and self.n_importance == 0
+        if self.n_importance > 0:
+            xyz_sampled, z_vals, ray_valid = self.sample_ray_importance(rays_chunk[:, :3], viewdirs, is_train=is_train, ndc_ray=ndc_ray)
+            dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+            if ndc_ray:
+                rays_norm = torch.norm(viewdirs, dim=-1, keepdim=True)
+                dists = dists * rays_norm
+                viewdirs = viewdirs / rays_norm
+        elif ndc_ray:
             xyz_sampled, z_vals, ray_valid = self.sample_ray_ndc(rays_chunk[:, :3], viewdirs, is_train=is_train,N_samples=N_samples)
             dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
             rays_norm = torch.norm(viewdirs, dim=-1, keepdim=True)
             dists = dists * rays_norm
             viewdirs = viewdirs / rays_norm
+        elif marched:
+            xyz_sampled, z_vals, ray_valid, dists = self.sample_ray_occupancy(rays_chunk[:, :3], viewdirs, is_train=is_train,N_samples=N_samples)
         else:
+            if self.clip_samples:
+                N_samples = self.clip_n_samples(rays_chunk[:, :3], viewdirs, N_samples=N_samples)
             xyz_sampled, z_vals, ray_valid = self.sample_ray(rays_chunk[:, :3], viewdirs, is_train=is_train,N_samples=N_samples)
             dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
         viewdirs = viewdirs.view(-1, 1, 3).expand(xyz_sampled.shape)
         
-        if self.alphaMask is not None:
+        if self.alphaMask is not None and not marched:
             alphas = self.alphaMask.sample_alpha(xyz_sampled[ray_valid])
             alpha_mask = alphas > 0
             ray_invalid = ~ray_valid
@@ -432,25 +1036,32 @@ class TensorBase(torch.nn.Module):
             ray_valid = ~ray_invalid
 
 
-        sigma = torch.zeros(xyz_sampled.shape[:-1], device=xyz_sampled.device)
-        rgb = torch.zeros((*xyz_sampled.shape[:2], 3), device=xyz_sampled.device)
+        if self.early_term_thres > 0 and not is_train:
+            weight, rgb = self.composite_segments(self.normalize_coord(xyz_sampled), viewdirs, dists, ray_valid)
+        else:
+            sigma = torch.zeros(xyz_sampled.shape[:-1], device=xyz_sampled.device)
+            rgb = torch.zeros((*xyz_sampled.shape[:2], 3), device=xyz_sampled.device)
 
-        if ray_valid.any():
-            xyz_sampled = self.normalize_coord(xyz_sampled)
-            sigma_feature = self.compute_densityfeature(xyz_sampled[ray_valid])
+            if ray_valid.any():
+                xyz_sampled = self.normalize_coord(xyz_sampled)
+                sigma_feature, valid_app_features = self.valid_features(xyz_sampled[ray_valid])
 
-            validsigma = self.feature2density(sigma_feature)
-            sigma[ray_valid] = validsigma
+                validsigma = self.feature2density(sigma_feature)
+                sigma[ray_valid] = validsigma
 
 
-        alpha, weight, bg_weight = raw2alpha(sigma, dists * self.distance_scale)
+            alpha, weight, bg_weight = raw2alpha(sigma, dists * self.distance_scale)
 
-        app_mask = weight > self.rayMarch_weight_thres
+            app_mask = weight > self.rayMarch_weight_thres
+            self.track_samples(ray_valid.numel(), ray_valid.sum(), app_mask.sum())
 
-        if app_mask.any():
-            app_features = self.compute_appfeature(xyz_sampled[app_mask])
-            valid_rgbs = self.renderModule(xyz_sampled[app_mask], viewdirs[app_mask], app_features)
-            rgb[app_mask] = valid_rgbs
+            if app_mask.any():
+                if valid_app_features is not None:
+                    app_features = valid_app_features[app_mask[ray_valid]]
+                else:
+                    app_features = self.compute_appfeature(xyz_sampled[app_mask])
+                valid_rgbs = self.shade(xyz_sampled[app_mask], viewdirs[app_mask], app_features)
+                rgb[app_mask] = valid_rgbs
 
         acc_map = torch.sum(weight, -1)
         rgb_map = torch.sum(weight[..., None] * rgb, -2)
@@ -25,7 +25,7 @@ def config_parser(cmd=None):
     parser.add_argument('--downsample_test', type=float, default=1.0)
 
     parser.add_argument('--model_name', type=str, default='TensorVMSplit',
-                        choices=['TensorVMSplit', 'TensorCP'])
+                        choices=['TensorVMSplit', 'TensorCP', 'TensorBaked'])
 
     # loader options
     parser.add_argument("--batch_size", type=int, default=4096)
@@ -59,6 +59,20 @@ def config_parser(cmd=None):
                         help='loss weight')
     parser.add_argument("--TV_weight_app", type=float, default=0.0,
                         help='loss weight')
+    parser.add_argument("--Ortho_every", type=int, default=1,
+                        help='evaluate the orthogonality loss every n iterations with n times its weight')
+    parser.add_argument("--L1_every", type=int, default=1,
+                        help='evaluate the density L1 loss every n iterations with n times its weight')
+    parser.add_argument("--TV_density_every", type=int, default=1,
+                        help='evaluate the density TV loss every n iterations with n times its weight')
+    parser.add_argument("--TV_app_every", type=int, default=1,
+                        help='evaluate the appearance TV loss every n iterations with n times its weight')
+    parser.add_argument("--L1_window", type=int, default=0,
+                        help='estimate the density L1 loss from one random window x window tile per plane, 0 uses whole planes')
+    parser.add_argument("--TV_density_window", type=int, default=0,
+                        help='estimate the density TV loss from one random window x window tile per plane, 0 uses whole planes')
+    parser.add_argument("--TV_app_window", type=int, default=0,
+                        help='estimate the appearance TV loss from one random window x window tile per plane, 0 uses whole planes')
     
     # model
     # volume options
@@ -96,6 +110,56 @@ def config_parser(cmd=None):
     parser.add_argument("--render_train", type=int, default=0)
     parser.add_argument("--render_path", type=int, default=0)
     parser.add_argument("--export_mesh", type=int, default=0)
+    parser.add_argument("--export_baked", type=int, default=0,
+                        help='bake the checkpoint into a brick-sparse feature grid saved next to it')
+    parser.add_argument("--render_baked", type=int, default=0,
+                        help='render with the baked feature grid of the checkpoint instead of the factorized model')
+    parser.add_argument("--bake_brick_size", type=int, default=8,
+                        help='brick edge length in voxels of the baked feature grid')
+    parser.add_argument("--render_precision", type=str, default='float32',
+                        choices=['float32', 'float16', 'bfloat16'],
+                        help='storage and compute precision of the features and MLP at inference, compositing stays float32. with render_test the test views are also rendered in float32 and the PSNR/SSIM change against ground truth is reported')
+    parser.add_argument("--render_workers", type=int, default=0,
+                        help='number of cpu processes rendering the frames of render_path in parallel, 0 (default) renders in this process. the workers start from a forkserver, which costs a few seconds up front')
+    parser.add_argument("--auto_chunk", type=int, default=0,
+                        help='size the ray chunks of training and evaluation from the memory budget instead of fixed sizes')
+    parser.add_argument("--chunk_mem_budget", type=float, default=0,
+                        help='memory budget in GB of one render chunk for auto_chunk, 0 uses 80%% of the free device memory')
+    parser.add_argument("--profile_stages", type=int, default=0,
+                        help='time the stages of the render forward and count samples, logged to tensorboard and profile.json')
+    parser.add_argument("--trace_iters", type=int, action="append",
+                        help='training iterations to capture with torch.profiler into {logfolder}/traces')
+    parser.add_argument("--trace_events", type=int, default=0,
+                        help='also capture the iterations of upsamp_list and update_AlphaMask_list')
+    parser.add_argument("--trace_before", type=int, default=2,
+                        help='iterations traced before each trace iteration')
+    parser.add_argument("--trace_after", type=int, default=3,
+                        help='iterations traced after each trace iteration')
+    parser.add_argument("--ray_buffer", type=str, default='host', choices=['host', 'auto', 'device', 'pinned'],
+                        help='where the training rays live: host tensors copied per batch (default), the device, '
+                             'pinned host memory with async batch uploads, or auto (device if it fits)')
+    parser.add_argument("--prefetch_batches", type=int, default=0,
+                        help='training batches gathered ahead by a background thread, 0 gathers them in the training loop')
+    parser.add_argument("--ray_sampler", type=str, default='uniform', choices=['uniform', 'importance'],
+                        help='draw training rays uniformly, or in proportion to a running per ray group loss estimate')
+    parser.add_argument("--sampler_group", type=int, default=64,
+                        help='consecutive rays sharing one loss estimate in the importance sampler')
+    parser.add_argument("--sampler_floor", type=float, default=0.2,
+                        help='share of the importance sampling probability spread uniformly over all rays')
+    parser.add_argument("--sampler_decay", type=float, default=0.9,
+                        help='decay of the moving average loss estimate of the importance sampler')
+    parser.add_argument("--amp", type=int, default=0,
+                        help='train with automatic mixed precision (feature products, basis_mat and renderModule)')
+    parser.add_argument("--amp_dtype", type=str, default='float16', choices=['float16', 'bfloat16'],
+                        help='low precision dtype of amp training, float16 uses a gradient scaler')
+    parser.add_argument("--keep_optimizer_state", type=int, default=0,
+                        help='resample/crop the Adam moments with the grids on upsampling and shrinking instead of restarting the optimizer')
+    parser.add_argument("--ckpt_every", type=int, default=0,
+                        help='save a training checkpoint (model, optimizer, schedule, sampler, rng) every n iterations into {logfolder}/ckpts')
+    parser.add_argument("--resume", type=str, default=None,
+                        help='training checkpoint to continue the run from, into the logfolder it was saved from')
+    parser.add_argument("--keep_ckpts", type=int, default=3,
+                        help='number of the latest training checkpoints kept in {logfolder}/ckpts, 0 keeps all')
 
     # rendering options
     parser.add_argument('--lindisp', default=False, action="store_true",
@@ -108,6 +172,27 @@ def config_parser(cmd=None):
     parser.add_argument('--nSamples', type=int, default=1e6,
                         help='sample point each ray, pass 1e6 if automatic adjust')
     parser.add_argument('--step_ratio',type=float,default=0.5)
+    parser.add_argument('--occupancy_march', type=int, default=0,
+                        help='only sample inside occupied alpha mask cells (DDA traversal of the mask)')
+    parser.add_argument('--early_term_thre', type=float, default=0.0,
+                        help='stop evaluating a ray once its transmittance is below this value (inference only, 0 disables)')
+    parser.add_argument('--early_term_segment', type=int, default=64,
+                        help='number of samples evaluated per ray between early termination checks')
+    parser.add_argument('--packed_samples', type=int, default=0,
+                        help='keep only the valid samples of a chunk in flat per-ray buffers instead of N_rays x N_samples tensors')
+    parser.add_argument('--clip_samples', type=int, default=0,
+                        help='stop sampling each ray at its aabb exit instead of using nSamples for every ray')
+    parser.add_argument('--n_importance', type=int, default=0,
+                        help='number of fine samples per ray placed from a coarse density pass, 0 disables hierarchical sampling')
+    parser.add_argument('--n_coarse', type=int, default=64,
+                        help='number of samples per ray in the coarse density-only pass')
+    parser.add_argument('--fused_features', type=int, default=0,
+                        help='gather density and appearance features of the valid samples in one pass while nearly all of them need appearance')
+    parser.add_argument('--alpha_mask_levels', type=int, default=0,
+                        help='coarse occupancy levels of the alpha mask (2^level cells per side) tested before its cells, with --alpha_mask_packed')
+    parser.add_argument('--alpha_mask_packed', type=int, default=0,
+                        help='answer alpha mask lookups from its bit-packed occupancy instead of a float volume, 32x less mask memory '
+                             'but slower than the float volume on cpu')
 
 
     ## blender flags
@@ -124,6 +209,11 @@ def config_parser(cmd=None):
                         default=300**3)
     parser.add_argument("--upsamp_list", type=int, action="append")
     parser.add_argument("--update_AlphaMask_list", type=int, action="append")
+    parser.add_argument("--update_AlphaMask_every", type=int, default=0,
+                        help='also update the alpha mask every n iterations after the first update of update_AlphaMask_list')
+    parser.add_argument("--alpha_mask_band", type=int, default=-1,
+                        help='update the alpha mask incrementally, only evaluating density inside the previous mask grown by '
+                             'this many voxels, -1 rebuilds it over the whole aabb')
 
     parser.add_argument('--idx_view',
                         type=int,
@@ -134,6 +224,9 @@ def config_parser(cmd=None):
     parser.add_argument("--vis_every", type=int, default=10000,
                         help='frequency of visualize the image')
     if cmd is not None:
-        return parser.parse_args(cmd)
+        args = parser.parse_args(cmd)
     else:
-        return parser.parse_args()
\ No newline at end of file
+        args = parser.parse_args()
+    if args.ray_sampler == 'importance' and args.prefetch_batches > 0:
+        parser.error('--prefetch_batches does not work with --ray_sampler importance, its draws depend on the loss of the batch before')
+    return args
\ No newline at end of file
@@ -1,29 +1,145 @@
-import torch,os,imageio,sys
+import torch,os,imageio,sys,queue,threading
+from types import SimpleNamespace
 from tqdm.auto import tqdm
 from dataLoader.ray_utils import get_rays
-from models.tensoRF import TensorVM, TensorCP, raw2alpha, TensorVMSplit, AlphaGridMask
+from models.tensoRF import TensorVM, TensorCP, raw2alpha, TensorVMSplit, AlphaGridMask, TensorBaked
 from utils import *
 from dataLoader.ray_utils import ndc_rays_blender
 
 
-def OctreeRender_trilinear_fast(rays, tensorf, chunk=4096, N_samples=-1, ndc_ray=False, white_bg=True, is_train=False, device='cuda'):
+class FrameWriter:
+    # writes the rendered frames to the videos (and pngs) on a background thread
+    def __init__(self, savePath, prtx='', save_imgs=0, fps=30, quality=8, maxsize=8):
+        self.savePath, self.prtx, self.save_imgs = savePath, prtx, save_imgs
+        self.fps, self.quality = fps, quality
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, idx, rgb_map, depth_map):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((idx, rgb_map, depth_map))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        savePath, prtx = self.savePath, self.prtx
+        rgb_writer = imageio.get_writer(f'{savePath}/{prtx}video.mp4', fps=self.fps, quality=self.quality)
+        depth_writer = imageio.get_writer(f'{savePath}/{prtx}depthvideo.mp4', fps=self.fps, quality=self.quality)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if self.error is not None:
+                    continue    # keep draining so the renderer never blocks on a dead writer
+                idx, rgb_map, depth_map = item
+                try:
+                    rgb_writer.append_data(rgb_map)
+                    depth_writer.append_data(depth_map)
+                    if self.save_imgs == 1:
+                        imageio.imwrite(f'{savePath}/{prtx}{idx:03d}.png', rgb_map)
+                        imageio.imwrite(f'{savePath}/rgbd/{prtx}{idx:03d}.png', np.concatenate((rgb_map, depth_map), axis=1))
+                except Exception as e:
+                    self.error = e
+        finally:
+            rgb_writer.close()
+            depth_writer.close()
+
+
+def ray_chunk_bytes(tensorf, N_samples=-1, is_train=False):
+    # bytes per ray through TensorBase.forward, from the sample shares of the model's last forward
+    n_samples = N_samples if N_samples > 0 else tensorf.nSamples
+    n_fine = n_samples
+    if tensorf.n_importance > 0:
+        n_fine = tensorf.n_importance
+        n_samples = max(n_samples, tensorf.n_coarse + tensorf.n_importance)
+    shares = tensorf.sample_shares()
+    valid_share, app_share = shares if shares is not None else (1.0, 1.0)
+    n_density = sum(tensorf.density_n_comp) if isinstance(tensorf.density_n_comp, (list, tuple)) else tensorf.density_n_comp
+    n_app = sum(tensorf.app_n_comp) if isinstance(tensorf.app_n_comp, (list, tuple)) else tensorf.app_n_comp
+    mlp_in = getattr(tensorf.renderModule, 'in_mlpC', 0)
+    featureC = tensorf.featureC if mlp_in > 0 else 0
+    if is_train:
+        valid_floats = 16 + 3 * n_density
+        app_floats = 42 + 5 * n_app + tensorf.app_dim + 3 * mlp_in + featureC
+    else:
+        valid_floats = 16 + n_density
+        app_floats = max(16 + 4 * n_app, 2 * mlp_in + 2 * featureC) + tensorf.app_dim
+    return 4 * (16 * n_samples + n_fine * (valid_share * valid_floats + app_share * app_floats))
+
+def free_memory_bytes(device):
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        # blocks held by the caching allocator are free for us too
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    try:
+        # MemAvailable counts the reclaimable page cache, the sysconf free pages do not
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024**3
+
+def auto_chunk_size(tensorf, N_samples=-1, is_train=False, mem_budget=0, device='cuda'):
+    # largest multiple of 1024 rays fitting the budget in GB, 0 uses 80% of the free device memory
+    budget = mem_budget * 1024**3 if mem_budget > 0 else 0.8 * free_memory_bytes(device)
+    chunk = int(budget // ray_chunk_bytes(tensorf, N_samples, is_train))
+    return chunk // 1024 * 1024 if chunk >= 1024 else max(chunk, 1)
+
+def is_oom_error(e):
+    # cuda raises OutOfMemoryError ("CUDA out of memory"), the cpu allocator a plain RuntimeError
+    return 'out of memory' in str(e) or "can't allocate memory" in str(e)
+
+def OctreeRender_trilinear_fast(rays, tensorf, chunk=4096, N_samples=-1, ndc_ray=False, white_bg=True, is_train=False, device='cuda', mem_budget=0):
+
+    # chunk=-1 sizes each chunk from the memory budget and halves it on OOM
+    auto = chunk <= 0
+    halved = False
+    if auto:
+        chunk = auto_chunk_size(tensorf, N_samples, is_train, mem_budget, device)
 
     rgbs, alphas, depth_maps, weights, uncertainties = [], [], [], [], []
     N_rays_all = rays.shape[0]
-    for chunk_idx in range(N_rays_all // chunk + int(N_rays_all % chunk > 0)):
-        rays_chunk = rays[chunk_idx * chunk:(chunk_idx + 1) * chunk].to(device)
-    
-        rgb_map, depth_map = tensorf(rays_chunk, is_train=is_train, white_bg=white_bg, ndc_ray=ndc_ray, N_samples=N_samples)
+    start = 0
+    while start < N_rays_all:
+        rays_chunk = rays[start:start + chunk].to(device)
+
+        try:
+            rgb_map, depth_map = tensorf(rays_chunk, is_train=is_train, white_bg=white_bg, ndc_ray=ndc_ray, N_samples=N_samples)
+        except RuntimeError as e:
+            if not auto or chunk <= 1 or not is_oom_error(e):
+                raise
+            del rays_chunk
+            if torch.device(device).type == 'cuda':
+                torch.cuda.empty_cache()
+            chunk //= 2
+            halved = True
+            continue
 
         rgbs.append(rgb_map)
         depth_maps.append(depth_map)
+        start += rays_chunk.shape[0]
+        if auto and not halved and start < N_rays_all:
+            chunk = auto_chunk_size(tensorf, N_samples, is_train, mem_budget, device)
     
     return torch.cat(rgbs), None, torch.cat(depth_maps), None, None
 
 @torch.no_grad()
 def evaluation(test_dataset,tensorf, args, renderer, savePath=None, N_vis=5, prtx='', N_samples=-1,
-               white_bg=False, ndc_ray=False, compute_extra_metrics=True, device='cuda', save_imgs=0):
-    PSNRs, rgb_maps, depth_maps = [], [], []
+               white_bg=False, ndc_ray=False, compute_extra_metrics=True, device='cuda', save_imgs=0, chunk=4096, mem_budget=0,
+               metrics=None):
+    # metrics: optional dict, gets the per view 'psnr' and 'ssim' lists
+    PSNRs = []
     ssims,l_alex,l_vgg=[],[],[]
     os.makedirs(savePath, exist_ok=True)
     os.makedirs(savePath+"/rgbd", exist_ok=True)
@@ -33,6 +149,7 @@ def evaluation(test_dataset,tensorf, args, renderer, savePath=None, N_vis=5, prt
     except Exception:
         pass
 
+    writer = FrameWriter(savePath, prtx, save_imgs=save_imgs, quality=10)
     near_far = test_dataset.near_far
     img_eval_interval = 1 if N_vis < 0 else max(test_dataset.all_rays.shape[0] // N_vis,1)
     idxs = list(range(0, test_dataset.all_rays.shape[0], img_eval_interval))
@@ -41,8 +158,8 @@ def evaluation(test_dataset,tensorf, args, renderer, savePath=None, N_vis=5, prt
         W, H = test_dataset.img_wh
         rays = samples.view(-1,samples.shape[-1])
 
-        rgb_map, _, depth_map, _, _ = renderer(rays, tensorf, chunk=4096, N_samples=N_samples,
-                                        ndc_ray=ndc_ray, white_bg = white_bg, device=device)
+        rgb_map, _, depth_map, _, _ = renderer(rays, tensorf, chunk=chunk, N_samples=N_samples,
+                                        ndc_ray=ndc_ray, white_bg = white_bg, device=device, mem_budget=mem_budget)
         rgb_map = rgb_map.clamp(0.0, 1.0)
 
         rgb_map, depth_map = rgb_map.reshape(H, W, 3).cpu(), depth_map.reshape(H, W).cpu()
@@ -63,17 +180,9 @@ def evaluation(test_dataset,tensorf, args, renderer, savePath=None, N_vis=5, prt
 
         rgb_map = (rgb_map.numpy() * 255).astype('uint8')
         # rgb_map = np.concatenate((rgb_map, depth_map), axis=1)
-        rgb_maps.append(rgb_map)
-        depth_maps.append(depth_map)
-        
-        if (save_imgs == 1):
-            if savePath is not None:
-                imageio.imwrite(f'{savePath}/{prtx}{idx:03d}.png', rgb_map)
-                rgb_map = np.concatenate((rgb_map, depth_map), axis=1)
-                imageio.imwrite(f'{savePath}/rgbd/{prtx}{idx:03d}.png', rgb_map)
+        writer.write(idx, rgb_map, depth_map)
 
-    imageio.mimwrite(f'{savePath}/{prtx}video.mp4', np.stack(rgb_maps), fps=30, quality=10)
-    imageio.mimwrite(f'{savePath}/{prtx}depthvideo.mp4', np.stack(depth_maps), fps=30, quality=10)
+    writer.close()
 
     if PSNRs:
         psnr = np.mean(np.asarray(PSNRs))
@@ -84,12 +193,59 @@ def evaluation(test_dataset,tensorf, args, renderer, savePath=None, N_vis=5, prt
             np.savetxt(f'{savePath}/{prtx}mean.txt', np.asarray([psnr, ssim, l_a, l_v]))
         else:
             np.savetxt(f'{savePath}/{prtx}mean.txt', np.asarray([psnr]))
+    if metrics is not None:
+        metrics.update({'psnr': PSNRs, 'ssim': ssims})
     return PSNRs
 
+def evaluation_precision(test_dataset, tensorf_ref, tensorf, args, renderer, savePath=None, prtx='', **kwargs):
+    # evaluates tensorf_ref (fp32) and its reduced precision copy, returns the per view PSNR and SSIM change
+    ref, low = {}, {}
+    evaluation(test_dataset, tensorf_ref, args, renderer, savePath, metrics=ref, **kwargs)
+    evaluation(test_dataset, tensorf, args, renderer, savePath, prtx=prtx, metrics=low, **kwargs)
+    delta = {key: np.asarray(low[key]) - np.asarray(ref[key]) for key in ('psnr', 'ssim') if len(ref[key])}
+    np.savetxt(f'{savePath}/{prtx}precision_delta.txt', np.asarray([[d.mean(), d.min()] for d in delta.values()]))
+    return delta
+
+@torch.no_grad()
+def render_path_frame(test_dataset, tensorf, c2w, renderer, N_samples=-1, white_bg=False, ndc_ray=False, device='cuda',
+                      chunk=8192, mem_budget=0):
+    W, H = test_dataset.img_wh
+
+    c2w = torch.FloatTensor(c2w)
+    rays_o, rays_d = get_rays(test_dataset.directions, c2w)  # both (h*w, 3)
+    if ndc_ray:
+        rays_o, rays_d = ndc_rays_blender(H, W, test_dataset.focal[0], 1.0, rays_o, rays_d)
+    rays = torch.cat([rays_o, rays_d], 1)  # (h*w, 6)
+
+    rgb_map, _, depth_map, _, _ = renderer(rays, tensorf, chunk=chunk, N_samples=N_samples,
+                                    ndc_ray=ndc_ray, white_bg = white_bg, device=device, mem_budget=mem_budget)
+    rgb_map = rgb_map.clamp(0.0, 1.0)
+
+    rgb_map, depth_map = rgb_map.reshape(H, W, 3).cpu(), depth_map.reshape(H, W).cpu()
+
+    depth_map, _ = visualize_depth_numpy(depth_map.numpy(),test_dataset.near_far)
+
+    rgb_map = (rgb_map.numpy() * 255).astype('uint8')
+    return rgb_map, depth_map
+
+
+# per-process state of the path render pool, set once by the initializer
+_path_frame_kwargs = None
+
+def _init_path_worker(frame_kwargs, n_threads):
+    global _path_frame_kwargs
+    torch.set_num_threads(n_threads)
+    _path_frame_kwargs = frame_kwargs
+
+def _render_path_worker(c2w):
+    return render_path_frame(c2w=c2w, **_path_frame_kwargs)
+
+
 @torch.no_grad()
 def evaluation_path(test_dataset,tensorf, c2ws, renderer, savePath=None, N_vis=5, prtx='', N_samples=-1,
-                    white_bg=False, ndc_ray=False, compute_extra_metrics=True, device='cuda', save_imgs=0):
-    PSNRs, rgb_maps, depth_maps = [], [], []
+                    white_bg=False, ndc_ray=False, compute_extra_metrics=True, device='cuda', save_imgs=0, num_workers=0,
+                    chunk=8192, mem_budget=0):
+    PSNRs = []
     ssims,l_alex,l_vgg=[],[],[]
     os.makedirs(savePath, exist_ok=True)
     os.makedirs(savePath+"/rgbd", exist_ok=True)
@@ -99,38 +255,38 @@ def evaluation_path(test_dataset,tensorf, c2ws, renderer, savePath=None, N_vis=5
     except Exception:
         pass
 
-    near_far = test_dataset.near_far
-    for idx, c2w in tqdm(enumerate(c2ws)):
-
-        W, H = test_dataset.img_wh
+    frame_kwargs = dict(test_dataset=test_dataset, tensorf=tensorf, renderer=renderer, N_samples=N_samples,
+                        white_bg=white_bg, ndc_ray=ndc_ray, device=device, chunk=chunk, mem_budget=mem_budget)
+    if num_workers > 0 and torch.device(device).type != 'cpu':
+        print('parallel path rendering is cpu only, falling back to a single process')
+        num_workers = 0
 
-        c2w = torch.FloatTensor(c2w)
-        rays_o, rays_d = get_rays(test_dataset.directions, c2w)  # both (h*w, 3)
-        if ndc_ray:
-            rays_o, rays_d = ndc_rays_blender(H, W, test_dataset.focal[0], 1.0, rays_o, rays_d)
-        rays = torch.cat([rays_o, rays_d], 1)  # (h*w, 6)
+    pool = None
+    if num_workers > 0:
+        # workers fork from a forkserver and share the weights, imap keeps the path order
+        tensorf.share_memory()
+        frame_kwargs['test_dataset'] = SimpleNamespace(img_wh=test_dataset.img_wh, directions=test_dataset.directions,
+                                                       focal=getattr(test_dataset, 'focal', None), near_far=test_dataset.near_far)
+        n_threads = max(torch.get_num_threads() // num_workers, 1)
+        if chunk <= 0:
+            # the workers share the host memory, so each one gets its slice of the budget
+            budget = mem_budget if mem_budget > 0 else 0.8 * free_memory_bytes(device) / 1024**3
+            frame_kwargs['mem_budget'] = budget / num_workers
+        ctx = torch.multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload([__name__])
+        pool = ctx.Pool(num_workers, _init_path_worker, (frame_kwargs, n_threads))
+        frames = pool.imap(_render_path_worker, c2ws)
+    else:
+        frames = (render_path_frame(c2w=c2w, **frame_kwargs) for c2w in c2ws)
 
-        rgb_map, _, depth_map, _, _ = renderer(rays, tensorf, chunk=8192, N_samples=N_samples,
-                                        ndc_ray=ndc_ray, white_bg = white_bg, device=device)
-        rgb_map = rgb_map.clamp(0.0, 1.0)
-
-        rgb_map, depth_map = rgb_map.reshape(H, W, 3).cpu(), depth_map.reshape(H, W).cpu()
-
-        depth_map, _ = visualize_depth_numpy(depth_map.numpy(),near_far)
-
-        rgb_map = (rgb_map.numpy() * 255).astype('uint8')
-        # rgb_map = np.concatenate((rgb_map, depth_map), axis=1)
-        rgb_maps.append(rgb_map)
-        depth_maps.append(depth_map)
+    writer = FrameWriter(savePath, prtx, save_imgs=save_imgs, quality=8)
+    for idx, (rgb_map, depth_map) in tqdm(enumerate(frames), total=len(c2ws)):
+        writer.write(idx, rgb_map, depth_map)
 
-        if (save_imgs == 1):
-            if savePath is not None:
-                imageio.imwrite(f'{savePath}/{prtx}{idx:03d}.png', rgb_map)
-                rgb_map = np.concatenate((rgb_map, depth_map), axis=1)
-                imageio.imwrite(f'{savePath}/rgbd/{prtx}{idx:03d}.png', rgb_map)
-        
-    imageio.mimwrite(f'{savePath}/{prtx}video.mp4', np.stack(rgb_maps), fps=30, quality=8)
-    imageio.mimwrite(f'{savePath}/{prtx}depthvideo.mp4', np.stack(depth_maps), fps=30, quality=8)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    writer.close()
 
     if PSNRs:
         psnr = np.mean(np.asarray(PSNRs))
@@ -0,0 +1,306 @@
+import queue, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def _generator_state(device):
+    # state of the generator a permutation on `device` is drawn from, None is numpy's
+    if device is None:
+        return np.random.get_state()
+    device = torch.device(device)
+    return torch.cuda.get_rng_state(device) if device.type == 'cuda' else torch.get_rng_state()
+
+
+def _set_generator_state(device, state):
+    if device is None:
+        np.random.set_state(state)
+    elif torch.device(device).type == 'cuda':
+        torch.cuda.set_rng_state(state, torch.device(device))
+    else:
+        torch.set_rng_state(state)
+
+
+class SimpleSampler:
+    def __init__(self, total, batch, device=None, gather=None):
+        self.total = total
+        self.batch = batch
+        self.curr = total
+        self.ids = None
+        self.device = device
+        self.gather = gather
+        self.perm_rng = None
+
+    def _permute(self):
+        if self.device is not None:
+            # ids for a device resident RayBuffer, drawn where they are used
+            self.ids = torch.randperm(self.total, device=self.device)
+        else:
+            self.ids = torch.LongTensor(np.random.permutation(self.total))
+
+    def nextids(self):
+        self.curr+=self.batch
+        if self.curr + self.batch > self.total:
+            self.perm_rng = _generator_state(self.device)
+            self._permute()
+            self.curr = 0
+        return self.ids[self.curr:self.curr+self.batch]
+
+    def nextbatch(self):
+        return self.gather(self.nextids())
+
+    def state_dict(self):
+        # the permutation itself is not stored, a resumed sampler redraws it from the generator state it came from
+        return {'curr': self.curr, 'perm_rng': self.perm_rng}
+
+    def load_state_dict(self, state):
+        self.curr, self.perm_rng = state['curr'], state['perm_rng']
+        if self.perm_rng is not None:
+            current = _generator_state(self.device)
+            _set_generator_state(self.device, self.perm_rng)
+            self._permute()
+            _set_generator_state(self.device, current)
+
+    def close(self):
+        pass
+
+
+class RayBuffer:
+    # training rays and colours as one [N, 9] tensor on the device or in pinned host memory ('auto' picks by size)
+    def __init__(self, all_rays, all_rgbs, device, placement='auto', mem_fraction=0.5):
+        self.device = torch.device(device)
+        self.n = all_rays.shape[0]
+        cuda = self.device.type == 'cuda'
+
+        nbytes = self.n * (all_rays.shape[-1] + all_rgbs.shape[-1]) * 4
+        if placement == 'auto':
+            placement = 'device' if not cuda or nbytes < mem_fraction * torch.cuda.mem_get_info(self.device)[0] else 'pinned'
+        self.placement = placement
+
+        if placement == 'device':
+            self.data = torch.empty((self.n, 9), device=self.device)
+        else:
+            self.data = torch.empty((self.n, 9), pin_memory=cuda)
+        self.data[:, :6].copy_(all_rays.view(-1, 6))
+        self.data[:, 6:].copy_(all_rgbs.view(-1, 3))
+
+        self.staging, self.events, self.slot = [None, None], [None, None], 0
+        print(f'ray buffer: {self.n} rays, {nbytes / 1024**3:.2f} GB on {placement}')
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def rays(self):
+        return self.data[:self.n, :6]
+
+    @property
+    def rgbs(self):
+        return self.data[:self.n, 6:]
+
+    def gather(self, ids):
+        # ids index the first len(self) rows, returns (rays [B, 6], rgbs [B, 3]) on the training device
+        if self.data.device == self.device:
+            batch = self.data[ids.to(self.device)]
+            return batch[:, :6], batch[:, 6:]
+
+        # host resident: gather into a pinned double buffer slot and upload without blocking
+        slot = self.slot
+        if self.events[slot] is not None:
+            self.events[slot].synchronize()
+        if self.staging[slot] is None or self.staging[slot].shape[0] < ids.shape[0]:
+            self.staging[slot] = torch.empty((ids.shape[0], 9), pin_memory=True)
+        staging = self.staging[slot][:ids.shape[0]]
+        torch.index_select(self.data, 0, ids.cpu(), out=staging)
+        batch = staging.to(self.device, non_blocking=True)
+        self.events[slot] = torch.cuda.Event()
+        self.events[slot].record()
+        self.slot = 1 - slot
+        return batch[:, :6], batch[:, 6:]
+
+    @torch.no_grad()
+    def filter_(self, mask, chunk=1 << 20):
+        # compacts the rows where mask is set to the front, in place
+        keep = torch.nonzero(mask.to(self.data.device)).squeeze(1)
+        for start in range(0, keep.shape[0], chunk):
+            idx = keep[start:start + chunk]
+            self.data[start:start + idx.shape[0]] = self.data[idx]
+        self.n = keep.shape[0]
+        return self
+
+
+class PrefetchSampler:
+    # gathers the next `prefetch` batches on a background thread, permutations come from its own generator
+    def __init__(self, total, batch, gather, device, ids_device='cpu', prefetch=2):
+        self.total = total
+        self.batch = batch
+        self.gather = gather
+        self.device = torch.device(device)
+        self.ids_device = torch.device(ids_device)
+        self.generator = torch.Generator(device=self.ids_device)
+        self.generator.manual_seed(int(torch.randint(1 << 62, (1,))))
+        self.perm_rng, self.curr, self.start = None, None, 0
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stop = threading.Event()
+        self.perm_worker = ThreadPoolExecutor(max_workers=1)
+        # started by the first nextbatch, after a resumed state is loaded
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _randperm(self):
+        perm_rng = self.generator.get_state()
+        ids = torch.randperm(self.total, device=self.ids_device, generator=self.generator)
+        if self.ids_device.type == 'cuda':
+            torch.cuda.current_stream(self.ids_device).synchronize()
+        return ids, perm_rng
+
+    def _batches(self):
+        # (ids, generator state of their permutation, offset in it), an epoch's incomplete tail is dropped
+        next_ids = self.perm_worker.submit(self._randperm)
+        first = self.start
+        while True:
+            ids, perm_rng = next_ids.result()
+            next_ids = self.perm_worker.submit(self._randperm)
+            for start in range(first, self.total - self.batch + 1, self.batch):
+                yield ids[start:start + self.batch], perm_rng, start
+            first = 0
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        cuda = self.device.type == 'cuda'
+        stream = torch.cuda.Stream(self.device) if cuda else None
+        try:
+            for ids, perm_rng, start in self._batches():
+                if self.stop.is_set():
+                    break
+                if cuda:
+                    with torch.cuda.stream(stream):
+                        rays, rgbs = self.gather(ids)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    (rays, rgbs), event = self.gather(ids), None
+                self._put((rays, rgbs, event, perm_rng, start))
+        except Exception as e:
+            self._put(e)
+
+    def nextbatch(self):
+        if self.thread.ident is None:
+            self.thread.start()
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        rays, rgbs, event, self.perm_rng, self.curr = item
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            # the batch was allocated on the side stream, keep its memory until the training stream is done with it
+            for t in (rays, rgbs):
+                if t.is_cuda:
+                    t.record_stream(current)
+        return rays, rgbs
+
+    def state_dict(self):
+        # the batches queued after the last one handed out are drawn again on resume
+        return {'curr': self.curr, 'perm_rng': self.perm_rng}
+
+    def load_state_dict(self, state):
+        if state.get('perm_rng') is not None:
+            self.generator.set_state(state['perm_rng'])
+            self.start = state['curr'] + self.batch
+
+    def close(self):
+        self.stop.set()
+        if self.thread.ident is not None:
+            self.thread.join()
+        self.perm_worker.shutdown(wait=True)
+
+
+class ImportanceSampler:
+    # draws groups of consecutive rays in proportion to a moving average of their mse, mixed with a uniform floor
+    def __init__(self, total, batch, gather, ids_device='cpu', group=64, floor=0.2, decay=0.9):
+        self.total = total
+        self.batch = batch
+        self.gather = gather
+        self.device = torch.device(ids_device)
+        self.group, self.floor, self.decay = group, floor, decay
+        self.n_groups = (total + group - 1) // group
+        self.err = torch.ones(self.n_groups, device=self.device)
+        self.seen = torch.zeros(self.n_groups, dtype=torch.bool, device=self.device)
+        self.ids = None
+
+    def nextids(self):
+        p = self.err / self.err.sum() * (1 - self.floor) + self.floor / self.n_groups
+        cdf = torch.cumsum(p, 0)
+        groups = torch.searchsorted(cdf, torch.rand(self.batch, device=self.device) * cdf[-1]).clamp(max=self.n_groups - 1)
+        start = groups * self.group
+        size = (self.total - start).clamp(max=self.group)
+        self.ids = start + (torch.rand(self.batch, device=self.device) * size).long()
+        return self.ids
+
+    def nextbatch(self):
+        return self.gather(self.nextids())
+
+    @torch.no_grad()
+    def update(self, ray_err):
+        # ray_err: [batch] per-ray mse of the last batch
+        groups = self.ids // self.group
+        ray_err = ray_err.detach().float().to(self.device)
+        err_sum = torch.zeros_like(self.err).index_add_(0, groups, ray_err)
+        count = torch.zeros_like(self.err).index_add_(0, groups, torch.ones_like(ray_err))
+        hit = count > 0
+        mean = err_sum[hit] / count[hit]
+        self.err[hit] = torch.where(self.seen[hit], self.decay * self.err[hit] + (1 - self.decay) * mean, mean)
+        self.seen |= hit
+
+    def _regroup(self, values, kept):
+        # means of the per group values over the kept rays of each new group, from prefix sums over the old groups
+        pad = values.shape[0] * self.group - kept.shape[0]
+        counts = torch.cat((kept, kept.new_zeros(pad))).view(-1, self.group).sum(1)
+        values = values.double()
+        kept_end = torch.cumsum(counts, 0)
+        sum_end = torch.cumsum(counts * values, 0)
+        bounds = torch.arange(self.n_groups + 1, device=self.device) * self.group
+        bounds[-1] = self.total
+        j = torch.searchsorted(kept_end, bounds, right=True).clamp(max=values.shape[0] - 1)
+        prefix = sum_end[j] - (kept_end[j] - bounds) * values[j]
+        return ((prefix[1:] - prefix[:-1]) / (bounds[1:] - bounds[:-1])).float()
+
+    def state_dict(self):
+        return {'err': self.err.cpu(), 'seen': self.seen.cpu()}
+
+    def load_state_dict(self, state, kept=None):
+        # kept: mask over the rays the state was saved for, when they have been filtered since
+        err, seen = state['err'].to(self.device), state['seen'].to(self.device)
+        if kept is not None:
+            kept = kept.to(self.device)
+            err, seen = self._regroup(err, kept), self._regroup(seen.float(), kept) > 0
+        self.err.copy_(err)
+        self.seen.copy_(seen)
+
+    def close(self):
+        pass
+
+
+def training_sampler(args, allrays, allrgbs, device, ray_buffer=None):
+    # batches of (rays, rgbs) on the device, drawn from the ray buffer when there is one
+    if ray_buffer is not None:
+        total, ids_device, gather = len(ray_buffer), ray_buffer.data.device, ray_buffer.gather
+    else:
+        total, ids_device = allrays.shape[0], None
+        gather = lambda ids: (allrays[ids], allrgbs[ids].to(device))
+    if args.ray_sampler == 'importance':
+        return ImportanceSampler(total, args.batch_size, gather, ids_device or 'cpu', group=args.sampler_group,
+                                 floor=args.sampler_floor, decay=args.sampler_decay)
+    if args.prefetch_batches > 0:
+        if ray_buffer is None:
+            # uploads the rays in the background too, the renderer's own .to(device) is then a no-op
+            gather = lambda ids: (allrays[ids].to(device), allrgbs[ids].to(device))
+        return PrefetchSampler(total, args.batch_size, gather, device, ids_device or 'cpu', prefetch=args.prefetch_batches)
+    return SimpleSampler(total, args.batch_size, ids_device, gather)
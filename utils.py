@@ -61,6 +61,32 @@ def N_to_reso(n_voxels, bbox):
 def cal_n_samples(reso, step_ratio=0.5):
     return int(np.linalg.norm(reso)/step_ratio)
 
+# rendering options taken from the config, also when a checkpoint is loaded
+def render_kwargs(args):
+    return {'occupancy_march': bool(args.occupancy_march),
+            'early_term_thres': args.early_term_thre,
+            'early_term_segment': args.early_term_segment,
+            'packed_samples': bool(args.packed_samples),
+            'clip_samples': bool(args.clip_samples),
+            'n_coarse': args.n_coarse,
+            'n_importance': args.n_importance,
+            'fused_features': bool(args.fused_features),
+            'alpha_mask_levels': args.alpha_mask_levels,
+            'alpha_mask_packed': bool(args.alpha_mask_packed)}
+
+def trace_iterations(args):
+    # iterations around which the training loop is captured with torch.profiler
+    iters = list(args.trace_iters or [])
+    if args.trace_events:
+        iters += list(args.upsamp_list or []) + list(args.update_AlphaMask_list or [])
+    return iters
+
+def chunk_kwargs(args):
+    # chunk=-1 makes OctreeRender_trilinear_fast size its chunks from mem_budget
+    if args.auto_chunk:
+        return {'chunk': -1, 'mem_budget': args.chunk_mem_budget}
+    return {}
+
 
 
 
@@ -138,10 +164,21 @@ def rgb_ssim(img0, img1, max_val,
 
 
 import torch.nn as nn
+def random_tile(shape, window):
+    # a uniformly drawn window x window tile of the last two dims, and the number of tiles
+    h, w = shape[-2:]
+    n_h, n_w = -(-h // window), -(-w // window)
+    tile = int(torch.randint(n_h * n_w, (1,)))
+    r0, c0 = tile // n_w * window, tile % n_w * window
+    return r0, min(r0 + window, h), c0, min(c0 + window, w), n_h * n_w
+
+
 class TVLoss(nn.Module):
-    def __init__(self,TVLoss_weight=1):
+    # window > 0 estimates the sums from one random tile per call, scaled by the number of tiles
+    def __init__(self,TVLoss_weight=1,window=0):
         super(TVLoss,self).__init__()
         self.TVLoss_weight = TVLoss_weight
+        self.window = window
 
     def forward(self,x):
         batch_size = x.size()[0]
@@ -150,14 +187,63 @@ class TVLoss(nn.Module):
         count_h = self._tensor_size(x[:,:,1:,:])
         count_w = self._tensor_size(x[:,:,:,1:])
         count_w = max(count_w, 1)
-        h_tv = torch.pow((x[:,:,1:,:]-x[:,:,:h_x-1,:]),2).sum()
-        w_tv = torch.pow((x[:,:,:,1:]-x[:,:,:,:w_x-1]),2).sum()
+        if self.window > 0 and (h_x > self.window or w_x > self.window):
+            r0, r1, c0, c1, n_tiles = random_tile(x.shape, self.window)
+            rows = x[:,:,max(r0-1,0):r1,c0:c1]
+            cols = x[:,:,r0:r1,max(c0-1,0):c1]
+            h_tv = torch.pow((rows[:,:,1:,:]-rows[:,:,:-1,:]),2).sum() * n_tiles
+            w_tv = torch.pow((cols[:,:,:,1:]-cols[:,:,:,:-1]),2).sum() * n_tiles
+        else:
+            h_tv = torch.pow((x[:,:,1:,:]-x[:,:,:h_x-1,:]),2).sum()
+            w_tv = torch.pow((x[:,:,:,1:]-x[:,:,:,:w_x-1]),2).sum()
         return self.TVLoss_weight*2*(h_tv/count_h+w_tv/count_w)/batch_size
 
     def _tensor_size(self,t):
         return t.size()[1]*t.size()[2]*t.size()[3]
 
 
+class L1Loss(nn.Module):
+    # mean absolute value, with window > 0 estimated from one random tile like TVLoss
+    def __init__(self,window=0):
+        super(L1Loss,self).__init__()
+        self.window = window
+
+    def forward(self,x):
+        if self.window > 0 and (x.size()[-2] > self.window or x.size()[-1] > self.window):
+            r0, r1, c0, c1, n_tiles = random_tile(x.shape, self.window)
+            return torch.abs(x[...,r0:r1,c0:c1]).sum() * n_tiles / x.numel()
+        return torch.mean(torch.abs(x))
+
+
+class MetricsAccumulator:
+    # running sums of the training scalars on the device, flush() fetches their means in one transfer
+    def __init__(self):
+        self.sums, self.counts = {}, {}
+
+    def add(self, name, value):
+        value = value.detach().float()
+        if name in self.sums:
+            self.sums[name] += value
+        else:
+            self.sums[name] = value.clone()
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def flush(self):
+        if not self.sums:
+            return {}
+        names = list(self.sums)
+        values = torch.stack([self.sums[name] for name in names]).tolist()
+        means = {name: value / self.counts[name] for name, value in zip(names, values)}
+        self.sums, self.counts = {}, {}
+        return means
+
+    def write_tensorboard(self, summary_writer, global_step, prefix='train'):
+        means = self.flush()
+        for name, value in means.items():
+            summary_writer.add_scalar(f'{prefix}/{name}', value, global_step=global_step)
+        return means
+
+
 
 import plyfile
 import skimage.measure
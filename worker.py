@@ -10,36 +10,25 @@ from renderer import *
 from utils import *
 from torch.utils.tensorboard import SummaryWriter
 from dataLoader import dataset_dict
+from samplers import RayBuffer, training_sampler
+from checkpoint import CheckpointWriter, training_ckpt, ray_filter, save_training_ckpt, set_rng_state
+from models.profiler import TraceWindow
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 renderer = OctreeRender_trilinear_fast
 
-class SimpleSampler:
-    def __init__(self, total, batch):
-        self.total = total
-        self.batch = batch
-        self.curr = total
-        self.ids = None
-
-    def nextids(self):
-        self.curr+=self.batch
-        if self.curr + self.batch > self.total:
-            self.ids = torch.LongTensor(np.random.permutation(self.total))
-            self.curr = 0
-        return self.ids[self.curr:self.curr+self.batch]
-
-
 @torch.no_grad()
 def export_mesh(args):
 
     ckpt = torch.load(args.ckpt, map_location=device)
     kwargs = ckpt['kwargs']
     kwargs.update({'device': device})
+    kwargs.update(render_kwargs(args))
     tensorf = eval(args.model_name)(**kwargs)
     tensorf.load(ckpt)
 
-    alpha,_ = tensorf.getDenseAlpha()
+    alpha = tensorf.dense_alpha()
     convert_sdf_samples_to_ply(alpha.cpu(), f'{args.ckpt[:-3]}.ply',bbox=tensorf.aabb.cpu(), level=0.005)
 
 
@@ -60,11 +49,12 @@ def render_novel_view(args, logfolder, tensorf_model):
         c2ws = test_dataset.render_path
         os.makedirs(f'{logfolder}/{args.expname}/imgs_path_all', exist_ok=True)
         evaluation_path(test_dataset,tensorf_model, c2ws, renderer, f'{logfolder}/{args.expname}/imgs_path_all/',
-                                N_vis=-1, N_samples=-1, white_bg = white_bg, ndc_ray=ndc_ray,device=device, args.png_mode)
+                                N_vis=-1, N_samples=-1, white_bg = white_bg, ndc_ray=ndc_ray,device=device, save_imgs=args.png_mode,
+                                num_workers=args.render_workers, **chunk_kwargs(args))
     else:
         os.makedirs(f'{logfolder}/imgs_render_all', exist_ok=True)
         evaluation(test_dataset,tensorf_model, args, renderer, f'{logfolder}/imgs_render_all/',
-                                N_vis=-1, N_samples=-1, white_bg = white_bg, ndc_ray=ndc_ray,device=device, args.png_mode)
+                                N_vis=-1, N_samples=-1, white_bg = white_bg, ndc_ray=ndc_ray,device=device, save_imgs=args.png_mode, **chunk_kwargs(args))
 
     # video saved to {logfolder}/{args.expname}/imgs_path_all/video.mp4
     return f'{logfolder}/imgs_path_all/video.mp4'
@@ -86,7 +76,12 @@ def train_tensorf(args):
     n_lamb_sh = args.n_lamb_sh
 
     
-    if args.add_timestamp:
+    # a resumed run continues in the logfolder of its checkpoint
+    resume = torch.load(args.resume, map_location=device) if args.resume is not None else None
+
+    if resume is not None:
+        logfolder = resume['loop']['logfolder']
+    elif args.add_timestamp:
         logfolder = f'{args.basedir}/{args.expname}{datetime.datetime.now().strftime("-%Y%m%d-%H%M%S")}'
     else:
         logfolder = f'{args.basedir}/{args.expname}'
@@ -108,17 +103,19 @@ def train_tensorf(args):
     nSamples = min(args.nSamples, cal_n_samples(reso_cur,args.step_ratio))
 
     # Load model checkpoint
-    if args.ckpt is not None:
-        ckpt = torch.load(args.ckpt, map_location=device)
+    if resume is not None or args.ckpt is not None:
+        ckpt = resume if resume is not None else torch.load(args.ckpt, map_location=device)
         kwargs = ckpt['kwargs']
         kwargs.update({'device':device})
+        kwargs.update(render_kwargs(args))
         tensorf = eval(args.model_name)(**kwargs)
         tensorf.load(ckpt)
     else:
         tensorf = eval(args.model_name)(aabb, reso_cur, device,
                     density_n_comp=n_lamb_sigma, appearance_n_comp=n_lamb_sh, app_dim=args.data_dim_color, near_far=near_far,
                     shadingMode=args.shadingMode, alphaMask_thres=args.alpha_mask_thre, density_shift=args.density_shift, distance_scale=args.distance_scale,
-                    pos_pe=args.pos_pe, view_pe=args.view_pe, fea_pe=args.fea_pe, featureC=args.featureC, step_ratio=args.step_ratio, fea2denseAct=args.fea2denseAct)
+                    pos_pe=args.pos_pe, view_pe=args.view_pe, fea_pe=args.fea_pe, featureC=args.featureC, step_ratio=args.step_ratio, fea2denseAct=args.fea2denseAct,
+                    **render_kwargs(args))
 
 
     # learning rate for Adam optimizer
@@ -133,6 +130,9 @@ def train_tensorf(args):
     
     # modifying the optimizer is a potential avenue for further performance gains
     optimizer = torch.optim.Adam(grad_vars, betas=(0.9,0.99))
+    if resume is not None:
+        # also carries the decayed learning rates
+        optimizer.load_state_dict(resume['optimizer'])
 
 
     #linear in logrithmic space
@@ -141,12 +141,24 @@ def train_tensorf(args):
 
 
     torch.cuda.empty_cache()
-    PSNRs,PSNRs_test = [],[0]
+    PSNRs_test = [0]
+    metrics = MetricsAccumulator()
 
     allrays, allrgbs = train_dataset.all_rays, train_dataset.all_rgbs
-    if not args.ndc_ray:
-        allrays, allrgbs = tensorf.filtering_rays(allrays, allrgbs, bbox_only=True)
-    trainingSampler = SimpleSampler(allrays.shape[0], args.batch_size)
+    # mask over all training rays of the ones trained on, a resumed run takes it from the checkpoint
+    rays_kept = ray_filter(resume) if resume is not None else None
+    if rays_kept is not None:
+        allrays, allrgbs = allrays[rays_kept], allrgbs[rays_kept]
+    elif not args.ndc_ray:
+        allrays, allrgbs, rays_kept = tensorf.filtering_rays(allrays, allrgbs, bbox_only=True, return_mask=True)
+    ray_buffer = None
+    if args.ray_buffer != 'host':
+        # the buffer holds the only copy of the training rays from here on
+        ray_buffer = RayBuffer(allrays, allrgbs, device, placement=args.ray_buffer)
+        allrays = allrgbs = train_dataset.all_rays = train_dataset.all_rgbs = None
+    trainingSampler = training_sampler(args, allrays, allrgbs, device, ray_buffer)
+    if resume is not None:
+        trainingSampler.load_state_dict(resume['sampler'])
 
     Ortho_reg_weight = args.Ortho_weight
     print("initial Ortho_reg_weight", Ortho_reg_weight)
@@ -154,59 +166,92 @@ def train_tensorf(args):
     L1_reg_weight = args.L1_weight_inital
     print("initial L1_reg_weight", L1_reg_weight)
     TV_weight_density, TV_weight_app = args.TV_weight_density, args.TV_weight_app
-    tvreg = TVLoss()
+    # window > 0 evaluates TV / L1 on one random tile of each plane per iteration
+    tvreg_density, tvreg_app = TVLoss(window=args.TV_density_window), TVLoss(window=args.TV_app_window)
+    l1reg = L1Loss(window=args.L1_window)
     print(f"initial TV_weight density: {TV_weight_density} appearance: {TV_weight_app}")
 
 
-    pbar = tqdm(range(args.n_iters), miniters=args.progress_refresh_rate, file=sys.stdout)
+    # only the render forward runs under autocast, the scaler lives for the whole run
+    amp_dtype = getattr(torch, args.amp_dtype)
+    amp = args.amp_dtype if args.amp else 'float32'
+    scaler = torch.cuda.amp.GradScaler(enabled=bool(args.amp) and amp_dtype == torch.float16 and device.type == 'cuda')
+
+    start_iter, reso_mask = 0, None
+    if resume is not None:
+        loop = resume['loop']
+        start_iter = loop['iteration'] + 1
+        reso_cur, reso_mask, nSamples, N_voxel_list = loop['reso_cur'], loop['reso_mask'], loop['nSamples'], loop['N_voxel_list']
+        L1_reg_weight, TV_weight_density, TV_weight_app = loop['L1_reg_weight'], loop['TV_weight_density'], loop['TV_weight_app']
+        lr_factor, PSNRs_test = loop['lr_factor'], loop['PSNRs_test']
+        tensorf.app_share, tensorf.fused_calls = loop['app_share'], loop['fused_calls']
+        if loop['amp'] == amp:
+            scaler.load_state_dict(resume['scaler'])
+        else:
+            print(f"checkpoint trained with amp {loop['amp']}, continuing with {amp} and a fresh gradient scaler")
+        # last, nothing may draw random numbers between here and the first iteration
+        set_rng_state(resume['rng'])
+        print(f'resuming {logfolder} at iteration {start_iter}')
+        del resume
+
+    ckpt_writer = CheckpointWriter(keep=args.keep_ckpts)
+    trace_iters = trace_iterations(args)
+    tracer = TraceWindow(logfolder, trace_iters, args.trace_before, args.trace_after) if trace_iters else None
+
+    pbar = tqdm(range(start_iter, args.n_iters), miniters=args.progress_refresh_rate, file=sys.stdout)
 
     # Main training loop
     for iteration in pbar:
+        if tracer is not None:
+            tracer.step(iteration)
         # sample image ray pair to train on (could batch this process)
-        ray_idx = trainingSampler.nextids()
-        rays_train, rgb_train = allrays[ray_idx], allrgbs[ray_idx].to(device)
+        rays_train, rgb_train = trainingSampler.nextbatch()
 
         #rgb_map, alphas_map, depth_map, weights, uncertainty
-        rgb_map, alphas_map, depth_map, weights, uncertainty = renderer(rays_train, tensorf, chunk=args.batch_size,
-                                N_samples=nSamples, white_bg = white_bg, ndc_ray=ndc_ray, device=device, is_train=True)
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=bool(args.amp)):
+            rgb_map, alphas_map, depth_map, weights, uncertainty = renderer(rays_train, tensorf, chunk=-1 if args.auto_chunk else args.batch_size,
+                                    N_samples=nSamples, white_bg = white_bg, ndc_ray=ndc_ray, device=device, is_train=True)
 
         # The primary loss is MSE of the rendered image vs the ground truth
         loss = torch.mean((rgb_map - rgb_train) ** 2)
+        if args.ray_sampler == 'importance':
+            trainingSampler.update(torch.mean((rgb_map - rgb_train) ** 2, -1))
 
         # loss
         total_loss = loss
-        if Ortho_reg_weight > 0:
+        # a regularizer evaluated every k iterations enters with k times its weight, the same gradient in expectation
+        if Ortho_reg_weight > 0 and iteration % args.Ortho_every == 0:
             loss_reg = tensorf.vector_comp_diffs()
-            total_loss += Ortho_reg_weight*loss_reg
-            summary_writer.add_scalar('train/reg', loss_reg.detach().item(), global_step=iteration)
-        if L1_reg_weight > 0:
-            loss_reg_L1 = tensorf.density_L1()
-            total_loss += L1_reg_weight*loss_reg_L1
-            summary_writer.add_scalar('train/reg_l1', loss_reg_L1.detach().item(), global_step=iteration)
+            total_loss += Ortho_reg_weight*args.Ortho_every*loss_reg
+            metrics.add('reg', loss_reg)
+        if L1_reg_weight > 0 and iteration % args.L1_every == 0:
+            loss_reg_L1 = tensorf.density_L1(l1reg)
+            total_loss += L1_reg_weight*args.L1_every*loss_reg_L1
+            metrics.add('reg_l1', loss_reg_L1)
 
         if TV_weight_density>0:
             TV_weight_density *= lr_factor
-            loss_tv = tensorf.TV_loss_density(tvreg) * TV_weight_density
-            total_loss = total_loss + loss_tv
-            summary_writer.add_scalar('train/reg_tv_density', loss_tv.detach().item(), global_step=iteration)
+            if iteration % args.TV_density_every == 0:
+                loss_tv = tensorf.TV_loss_density(tvreg_density) * TV_weight_density
+                total_loss = total_loss + loss_tv*args.TV_density_every
+                metrics.add('reg_tv_density', loss_tv)
         if TV_weight_app>0:
             TV_weight_app *= lr_factor
-            loss_tv = loss_tv + tensorf.TV_loss_app(tvreg)*TV_weight_app
-            total_loss = total_loss + loss_tv
-            summary_writer.add_scalar('train/reg_tv_app', loss_tv.detach().item(), global_step=iteration)
+            if iteration % args.TV_app_every == 0:
+                loss_tv = tensorf.TV_loss_app(tvreg_app)*TV_weight_app
+                total_loss = total_loss + loss_tv*args.TV_app_every
+                metrics.add('reg_tv_app', loss_tv)
 
         # backprop step that optimizes the radiance field model
         optimizer.zero_grad()
-        total_loss.backward()
-        optimizer.step()
+        scaler.scale(total_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        # detach loss from gradiant graph and converts it to a float
-        loss = loss.detach().item()
-        
-        # logging
-        PSNRs.append(-10.0 * np.log(loss) / np.log(10.0))
-        summary_writer.add_scalar('train/PSNR', PSNRs[-1], global_step=iteration)
-        summary_writer.add_scalar('train/mse', loss, global_step=iteration)
+        # logging, accumulated on the device and only fetched every progress_refresh_rate iterations
+        loss = loss.detach()
+        metrics.add('PSNR', -10.0 * torch.log10(loss))
+        metrics.add('mse', loss)
 
         # update learning rate
         for param_group in optimizer.param_groups:
@@ -214,23 +259,30 @@ def train_tensorf(args):
 
         # Print the current values of the losses.
         if iteration % args.progress_refresh_rate == 0:
+            train_metrics = metrics.write_tensorboard(summary_writer, iteration)
             pbar.set_description(
                 f'Iteration {iteration:05d}:'
-                + f' train_psnr = {float(np.mean(PSNRs)):.2f}'
+                + f' train_psnr = {train_metrics["PSNR"]:.2f}'
                 + f' test_psnr = {float(np.mean(PSNRs_test)):.2f}'
-                + f' mse = {loss:.6f}'
+                + f' mse = {train_metrics["mse"]:.6f}'
             )
-            PSNRs = []
 
 
         # Every few thousand iterations mask voxel representation to lower memory consumption
-        if iteration in update_AlphaMask_list:
+        if iteration in update_AlphaMask_list or (args.update_AlphaMask_every > 0 and iteration > update_AlphaMask_list[0]
+                                                 and iteration % args.update_AlphaMask_every == 0):
 
             if reso_cur[0] * reso_cur[1] * reso_cur[2]<256**3:# update volume resolution
                 reso_mask = reso_cur
-            new_aabb = tensorf.updateAlphaMask(tuple(reso_mask))
+            new_aabb = tensorf.updateAlphaMask(tuple(reso_mask), band=args.alpha_mask_band)
             if iteration == update_AlphaMask_list[0]:
-                tensorf.shrink(new_aabb)
+                tensorf.shrink(new_aabb, optimizer if args.keep_optimizer_state else None)
+                if not args.keep_optimizer_state:
+                    # the cropped grids are new Parameters, the optimizer follows them at its current learning rates
+                    grad_vars = tensorf.get_optparam_groups()
+                    for new_group, param_group in zip(grad_vars, optimizer.param_groups):
+                        new_group['lr'] = param_group['lr']
+                    optimizer = torch.optim.Adam(grad_vars, betas=(0.9, 0.99))
                 # tensorVM.alphaMask = None
                 L1_reg_weight = args.L1_weight_rest
                 print("continuing L1_reg_weight", L1_reg_weight)
@@ -238,8 +290,18 @@ def train_tensorf(args):
 
             if not args.ndc_ray and iteration == update_AlphaMask_list[1]:
                 # filter rays outside the bbox
-                allrays,allrgbs = tensorf.filtering_rays(allrays,allrgbs)
-                trainingSampler = SimpleSampler(allrgbs.shape[0], args.batch_size)
+                trainingSampler.close()
+                if ray_buffer is not None:
+                    kept = tensorf.filtering_mask(ray_buffer.rays)
+                    ray_buffer.filter_(kept)
+                else:
+                    allrays,allrgbs,kept = tensorf.filtering_rays(allrays,allrgbs,return_mask=True)
+                rays_kept = rays_kept.clone()
+                rays_kept[rays_kept.clone()] = kept.to(rays_kept.device)
+                sampler_state = trainingSampler.state_dict()
+                trainingSampler = training_sampler(args, allrays, allrgbs, device, ray_buffer)
+                if args.ray_sampler == 'importance':
+                    trainingSampler.load_state_dict(sampler_state, kept)
 
         # potential hyper parameter tuning
         # Gradually increase from initial to final voxel count
@@ -247,7 +309,7 @@ def train_tensorf(args):
             n_voxels = N_voxel_list.pop(0)
             reso_cur = N_to_reso(n_voxels, tensorf.aabb)
             nSamples = min(args.nSamples, cal_n_samples(reso_cur,args.step_ratio))
-            tensorf.upsample_volume_grid(reso_cur)
+            tensorf.upsample_volume_grid(reso_cur, optimizer if args.keep_optimizer_state else None)
 
             if args.lr_upsample_reset:
                 print("reset lr to initial")
@@ -255,11 +317,28 @@ def train_tensorf(args):
             else:
                 lr_scale = args.lr_decay_target_ratio ** (iteration / args.n_iters)
             grad_vars = tensorf.get_optparam_groups(args.lr_init*lr_scale, args.lr_basis*lr_scale)
-            optimizer = torch.optim.Adam(grad_vars, betas=(0.9, 0.99))
+            if args.keep_optimizer_state:
+                # the resampled grids already carry their Adam moments, only the learning rates are reset
+                for param_group, new_group in zip(optimizer.param_groups, grad_vars):
+                    param_group['lr'] = new_group['lr']
+            else:
+                optimizer = torch.optim.Adam(grad_vars, betas=(0.9, 0.99))
+
+        if args.ckpt_every > 0 and iteration % args.ckpt_every == args.ckpt_every - 1:
+            loop = {'iteration': iteration, 'logfolder': logfolder, 'reso_cur': reso_cur, 'reso_mask': reso_mask,
+                    'nSamples': nSamples, 'N_voxel_list': N_voxel_list, 'L1_reg_weight': L1_reg_weight,
+                    'TV_weight_density': TV_weight_density, 'TV_weight_app': TV_weight_app,
+                    'lr_factor': lr_factor, 'PSNRs_test': PSNRs_test, 'app_share': tensorf.app_share,
+                    'fused_calls': tensorf.fused_calls, 'amp': amp}
+            save_training_ckpt(ckpt_writer, training_ckpt(tensorf, optimizer, scaler, trainingSampler, rays_kept, loop), logfolder, iteration)
         
+    trainingSampler.close()
+    if tracer is not None:
+        tracer.close()
 
-    # save model to file
-    tensorf.save(f'{logfolder}/{args.expname}.th')
+    # save model to file, rendering only starts once it is on disk
+    ckpt_writer.write(tensorf.get_ckpt(), f'{logfolder}/{args.expname}.th')
+    ckpt_writer.close()
     return logfolder, tensorf
 
 
@@ -292,15 +371,24 @@ def main():
         ckpt = torch.load(args.ckpt, map_location=device)
         kwargs = ckpt['kwargs']
         kwargs.update({'device': device})
+        kwargs.update(render_kwargs(args))
         tensorf_model = eval(args.model_name)(**kwargs)
         tensorf_model.load(ckpt)
         logfolder = os.path.dirname(args.ckpt)
+    elif args.model_name == 'TensorBaked':
+        print('baked models are inference only, train TensorVMSplit or TensorCP and bake it with --export_baked')
+        return
     else:
         # train TensoRF on all input data and saves model to file
         # (in the future train on part, test to confirm performance, then train on test set)
         logfolder, tensorf_model = train_tensorf(args)
 
 
+    if args.render_baked:
+        tensorf_model = TensorBaked.from_model(tensorf_model, brick_size=args.bake_brick_size)
+    if args.render_precision != 'float32':
+        tensorf_model.set_feature_dtype(getattr(torch, args.render_precision))
+
     # Render new video (can be combined with train)
     # Currently evaluation_path takes in a dataset object that has desired rays to render
     video_filepath = render_novel_view(args, logfolder, tensorf_model)